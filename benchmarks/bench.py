@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for gpsdio_vectortile
+
+    $ python benchmarks/bench.py run --distribution port --count 1000000
+    $ python benchmarks/bench.py compare benchmark-results.jsonl
+
+run generates synthetic input (see synthetic.py) into --data-dir, reusing
+it on later runs, and times ingest, generate_tree, generate_tiles and
+header generation separately, each in a process of its own so that the
+peak RSS of every stage is measured on its own. One JSON line per stage
+is appended to the results file, tagged with the current git commit, so
+that results from different commits can be compared with compare.
+"""
+
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+from gpsdio_vectortile import quad_tree
+from gpsdio_vectortile import quad_tree_node
+
+
+STAGES = ("ingest", "generate_tree", "generate_tiles", "headers")
+
+
+def stage_ingest(infile, params, workers):
+    tree = quad_tree.Quadtree(infile, __bare__ = True, **params)
+    tree.root = quad_tree_node.QuadtreeNode(tree)
+    tree.root.count = tree.ingest(infile, tree.root.source_filename)
+    tree.save()
+    return tree.root.count
+
+
+def stage_generate_tree(infile, params, workers):
+    tree = quad_tree.Quadtree.load()
+    tree.root.generate_tree(workers = workers)
+    tree.save()
+    return tree.root.count
+
+
+def stage_generate_tiles(infile, params, workers):
+    tree = quad_tree.Quadtree.load()
+    tree.generate_tiles(workers)
+    return tree.root.count
+
+
+def stage_headers(infile, params, workers):
+    tree = quad_tree.Quadtree.load()
+    tree.generate_header()
+    tree.generate_workspace()
+    return tree.root.count
+
+
+def _run_stage(conn, stage, infile, params, workers):
+    try:
+        devnull = open(os.devnull, "w")
+        sys.stdout = devnull
+        start = time.time()
+        rows = globals()["stage_" + stage](infile, params, workers)
+        seconds = time.time() - start
+        conn.send({"rows": rows,
+                   "seconds": seconds,
+                   "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   "children_maxrss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss})
+    except Exception:
+        conn.send({"error": traceback.format_exc()})
+
+
+def run_stage(stage, infile, params, workers):
+    """Runs stage in a new process in the current directory and returns
+    its rows, time and peak RSS."""
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_stage, args=(child, stage, infile, params, workers))
+    process.start()
+    result = parent.recv()
+    process.join()
+    if "error" in result:
+        raise click.ClickException("%s failed:\n%s" % (stage, result["error"]))
+    return result
+
+
+def get_commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, dirnames, names in os.walk(path)
+               for name in names)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("outfile")
+@click.option("--distribution", type=click.Choice(synthetic.DISTRIBUTIONS), default="uniform")
+@click.option("--count", type=float, default=1e5, help="Number of rows, e.g. 1e6.")
+@click.option("--seed", type=int, default=0)
+def generate(outfile, distribution, count, seed):
+    """Writes synthetic AIS tracks to OUTFILE."""
+    synthetic.generate(outfile, distribution, int(count), seed)
+
+
+@cli.command()
+@click.option("--distribution", type=click.Choice(synthetic.DISTRIBUTIONS), multiple=True,
+              help="Distributions to run, all of them by default.")
+@click.option("--count", type=float, multiple=True,
+              help="Number of rows, e.g. 1e5 (the default) up to 1e8. May be given multiple times.")
+@click.option("--seed", type=int, default=0)
+@click.option("--workers", type=int, default=1, metavar="N")
+@click.option("--max-count", type=int, default=quad_tree.Quadtree.max_count)
+@click.option("--max-depth", type=int, default=None)
+@click.option("--record-format", type=click.Choice(["msgpack", "binary"]), default="msgpack")
+@click.option("--builder", type=click.Choice(["partition", "sort"]), default="partition")
+@click.option("--data-dir", default="benchmark-data", metavar="DIR",
+              help="Where synthetic input is generated and kept between runs.")
+@click.option("--results", default="benchmark-results.jsonl", metavar="FILE",
+              help="File results are appended to.")
+@click.option("--keep", is_flag=True, help="Keep the generated tilesets.")
+def run(distribution, count, seed, workers, max_count, max_depth, record_format, builder, data_dir,
+        results, keep):
+    """Times every stage of generating tilesets for synthetic input."""
+    distributions = distribution or synthetic.DISTRIBUTIONS
+    counts = [int(c) for c in count or (1e5,)]
+    params = {"max_count": max_count, "max_depth": max_depth, "record_format": record_format,
+              "tree_builder": builder}
+    commit = get_commit()
+    results = os.path.abspath(results)
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    for distribution in distributions:
+        for count in counts:
+            infile = os.path.abspath(os.path.join(data_dir, "%s-%s-%s.msg" % (distribution, count, seed)))
+            if not os.path.exists(infile):
+                click.echo("Generating %s" % infile)
+                synthetic.generate(infile + ".tmp", distribution, count, seed)
+                os.rename(infile + ".tmp", infile)
+
+            workdir = tempfile.mkdtemp(prefix="vectortile-benchmark-")
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                for stage in STAGES:
+                    result = run_stage(stage, infile, params, workers)
+                    record = dict(params,
+                                  commit=commit,
+                                  date=datetime.datetime.utcnow().isoformat(),
+                                  distribution=distribution,
+                                  count=count,
+                                  seed=seed,
+                                  workers=workers,
+                                  stage=stage,
+                                  seconds=result["seconds"],
+                                  rows_per_second=result["rows"] / max(result["seconds"], 1e-6),
+                                  maxrss=result["maxrss"],
+                                  children_maxrss=result["children_maxrss"],
+                                  disk_bytes=directory_size(workdir))
+                    with open(results, "a") as f:
+                        f.write(json.dumps(record, sort_keys=True) + "\n")
+                    click.echo("%-8s %10s %-15s %8.2fs %10.0f rows/s %8s kB" % (
+                            distribution, count, stage, record["seconds"],
+                            record["rows_per_second"], max(record["maxrss"], record["children_maxrss"])))
+            finally:
+                os.chdir(cwd)
+                if keep:
+                    click.echo("Kept %s" % workdir)
+                else:
+                    shutil.rmtree(workdir)
+
+
+@cli.command()
+@click.argument("results", type=click.File())
+@click.option("--commit", multiple=True,
+              help="Commits to compare, in order. Defaults to all of them in the order first run.")
+def compare(results, commit):
+    """Prints the time and peak RSS of every stage per commit, and the
+    change of the last commit relative to the first."""
+    records = [json.loads(line) for line in results if line.strip()]
+    commits = list(commit)
+    if not commits:
+        for record in records:
+            if record["commit"] not in commits:
+                commits.append(record["commit"])
+
+    # The last result for each configuration and commit
+    latest = {}
+    for record in records:
+        key = (record["distribution"], record["count"], record["workers"],
+               record.get("max_count"), record.get("max_depth"),
+               record.get("record_format"), record.get("tree_builder"), record["stage"])
+        latest[key + (record["commit"],)] = record
+
+    keys = sorted(set(key[:-1] for key in latest),
+                  key=lambda key: key[:-1] + (STAGES.index(key[-1]),))
+    click.echo("%-8s %10s %3s %-15s %s %9s" % (
+            "dist", "count", "wrk", "stage",
+            " ".join("%18s" % c for c in commits), "change"))
+    for key in keys:
+        row = [latest.get(key + (c,)) for c in commits]
+        cells = " ".join("%18s" % ("%.2fs %dM" % (r["seconds"], max(r["maxrss"], r["children_maxrss"]) // 1024)
+                                   if r else "-")
+                         for r in row)
+        change = ""
+        if len(commits) > 1 and row[0] and row[-1]:
+            change = "%+.1f%%" % (100.0 * (row[-1]["seconds"] / max(row[0]["seconds"], 1e-6) - 1))
+        click.echo("%-8s %10s %3s %-15s %s %9s" % (key[0], key[1], key[2], key[-1], cells, change))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,132 @@
+"""
+Synthetic AIS tracks for benchmarking
+
+Every vessel sails a track of points_per_track positions reported every
+report_interval seconds. Where the tracks are depends on the
+distribution:
+
+uniform
+    Tracks start anywhere on the globe (uniform by area) and head off
+    in a random direction at 5 to 20 knots.
+port
+    Most vessels loiter at a few knots within a few km of a port, picked
+    with Zipf-like weights so that a handful of ports get most traffic.
+lane
+    Vessels sail at 10 to 20 knots along shipping lanes between pairs of
+    ports, with a few km of cross track noise.
+
+The same seed gives the same rows.
+"""
+
+import datetime
+import gpsdio
+import numpy
+
+
+DISTRIBUTIONS = ("uniform", "port", "lane")
+
+# (lat, lon) of some busy ports.
+PORTS = numpy.array([
+        (1.26, 103.84),    # Singapore
+        (31.23, 121.49),   # Shanghai
+        (51.95, 4.14),     # Rotterdam
+        (22.29, 114.16),   # Hong Kong
+        (35.10, 129.04),   # Busan
+        (53.54, 9.98),     # Hamburg
+        (33.74, -118.27),  # Los Angeles
+        (40.67, -74.04),   # New York
+        (25.01, 55.06),    # Jebel Ali
+        (51.23, 4.40),     # Antwerp
+        (-23.96, -46.30),  # Santos
+        (29.95, 32.55),    # Suez
+        (9.35, -79.91),    # Colon
+        (-33.91, 18.43),   # Cape Town
+        (59.90, 10.74),    # Oslo
+        (35.45, 139.65),   # Yokohama
+        ])
+
+START_TIME = datetime.datetime(2015, 1, 1)
+NM_PER_DEGREE = 60.0
+
+
+def port_weights(count):
+    weights = 1.0 / numpy.arange(1, count + 1)
+    return weights / weights.sum()
+
+
+def track_starts(distribution, random, vessels):
+    """Returns the start lat, lon, heading in degrees and speed in knots
+    of the tracks of vessels vessels, and the per step noise in
+    degrees."""
+    if distribution == "uniform":
+        lat = numpy.degrees(numpy.arcsin(random.uniform(-1, 1, vessels)))
+        lon = random.uniform(-180, 180, vessels)
+        heading = random.uniform(0, 360, vessels)
+        speed = random.uniform(5, 20, vessels)
+        return lat, lon, heading, speed, 0.0
+    if distribution == "port":
+        port = random.choice(len(PORTS), vessels, p=port_weights(len(PORTS)))
+        lat = PORTS[port, 0] + random.normal(0, 0.05, vessels)
+        lon = PORTS[port, 1] + random.normal(0, 0.05, vessels)
+        heading = random.uniform(0, 360, vessels)
+        speed = random.uniform(0, 3, vessels)
+        return lat, lon, heading, speed, 0.002
+    if distribution == "lane":
+        weights = port_weights(len(PORTS))
+        origin = random.choice(len(PORTS), vessels, p=weights)
+        destination = (origin + 1 + random.choice(len(PORTS) - 1, vessels)) % len(PORTS)
+        progress = random.uniform(0, 1, vessels)
+        dlat = PORTS[destination, 0] - PORTS[origin, 0]
+        dlon = PORTS[destination, 1] - PORTS[origin, 1]
+        lat = PORTS[origin, 0] + progress * dlat + random.normal(0, 0.03, vessels)
+        lon = PORTS[origin, 1] + progress * dlon + random.normal(0, 0.03, vessels)
+        heading = numpy.degrees(numpy.arctan2(dlon * numpy.cos(numpy.radians(lat)), dlat)) % 360
+        speed = random.uniform(10, 20, vessels)
+        return lat, lon, heading, speed, 0.005
+    raise ValueError("Unknown distribution %s" % distribution)
+
+
+def iter_batches(distribution, count, seed = 0, points_per_track = 100,
+                 report_interval = 180, vessels = 1000, batch_size = 100000):
+    """Yields dicts of numpy arrays with the columns of up to batch_size
+    rows at a time, count rows in total."""
+    random = numpy.random.RandomState(seed)
+    tracks = max(1, batch_size // points_per_track)
+    steps = numpy.arange(points_per_track)
+    done = 0
+    track = 0
+    while done < count:
+        lat, lon, heading, speed, noise = track_starts(distribution, random, tracks)
+        step_degrees = speed * report_interval / 3600.0 / NM_PER_DEGREE
+        dlat = step_degrees * numpy.cos(numpy.radians(heading))
+        dlon = step_degrees * numpy.sin(numpy.radians(heading)) / numpy.maximum(
+            numpy.cos(numpy.radians(lat)), 0.1)
+        lats = lat[:, None] + dlat[:, None] * steps + random.normal(0, noise, (tracks, points_per_track))
+        lons = lon[:, None] + dlon[:, None] * steps + random.normal(0, noise, (tracks, points_per_track))
+        track_ids = track + numpy.arange(tracks)
+        vessel_ids = track_ids % vessels
+        start_offsets = random.randint(0, 365 * 24 * 3600, tracks)
+
+        n = min(tracks * points_per_track, count - done)
+        yield {"mmsi": (200000000 + numpy.repeat(vessel_ids, points_per_track))[:n],
+               "track": numpy.repeat(track_ids, points_per_track)[:n],
+               "lat": numpy.clip(lats, -85, 85).ravel()[:n],
+               "lon": ((lons + 180) % 360 - 180).ravel()[:n],
+               "course": numpy.repeat(heading, points_per_track)[:n],
+               "speed": numpy.repeat(speed, points_per_track)[:n],
+               "seconds": (start_offsets[:, None] + steps * report_interval).ravel()[:n]}
+        done += n
+        track += tracks
+
+
+def generate(filename, distribution, count, seed = 0, **kw):
+    """Writes count rows of the distribution to filename using
+    gpsdio."""
+    with gpsdio.open(filename, "w") as dst:
+        for batch in iter_batches(distribution, count, seed, **kw):
+            columns = [(key, value.tolist()) for key, value in batch.iteritems()]
+            for values in zip(*[value for key, value in columns]):
+                row = dict(zip([key for key, value in columns], values))
+                row["timestamp"] = START_TIME + datetime.timedelta(seconds=row.pop("seconds"))
+                row["type"] = 1
+                dst.write(row)
@@ -1,75 +1,238 @@
+import array
 import datetime
-import math
+import hashlib
+import itertools
+import numpy
 
-class Cluster(object):
-    def __init__(self):
-        self.counts = {}
-        self.sums = {}
-        self.sqr_sums = {}
+
+def _append_at(values, index, value, fill = 0.0):
+    """Appends value to the array.array values as its item number
+    index, padding the items before it with fill."""
+    if len(values) < index:
+        values.extend(itertools.repeat(fill, index - len(values)))
+    values.append(value)
+
+def _to_column(values, length, fill = 0.0):
+    """Returns the array.array values padded with fill to length items
+    as a numpy array."""
+    column = numpy.empty(length)
+    column.fill(fill)
+    if len(values):
+        column[:len(values)] = numpy.frombuffer(values)
+    return column
+
+
+class ClusterSet(object):
+    """A set of clusters stored column wise: counts, means and m2s are
+    arrays with one row per cluster and one column per entry in
+    columns, where means and m2s are 0 for missing columns.
+
+    Clusters are merged with the parallel algorithm of Chan et al.,
+    which unlike sums of squares does not lose the variance of large
+    values such as timestamps in milliseconds. They are stored as
+    cluster rows holding counts__X, means__X and m2s__X for every
+    column X, and tiles get rows holding X and X_stddev."""
+
+    stat_names = ("counts", "means", "m2s")
+
+    def __init__(self, columns = None, counts = None, means = None, m2s = None):
+        self.columns = columns or []
+        shape = (0, len(self.columns))
+        self.counts = counts if counts is not None else numpy.zeros(shape)
+        self.means = means if means is not None else numpy.zeros(shape)
+        self.m2s = m2s if m2s is not None else numpy.zeros(shape)
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    @classmethod
+    def _from_columns(cls, length, columns):
+        """columns maps column names to tuples of stats (one per name in
+        stat_names), each an array.array of values by cluster index,
+        filled in with _append_at()."""
+        names = sorted(columns.iterkeys())
+        stats = [numpy.zeros((length, len(names))) for stat in cls.stat_names]
+        for col, name in enumerate(names):
+            for stat, values in zip(stats, columns[name]):
+                stat[:, col] = _to_column(values, length)
+        return cls(names, *stats)
 
     @classmethod
-    def from_cluster_row(cls, row):
-        self = cls()
-        for key, value in row.iteritems():
-            if key.startswith("counts__"):
-                key = key[len("counts__"):]
-                self.counts[key] = value
-            elif key.startswith("sums__"):
-                key = key[len("sums__"):]
-                self.sums[key] = value
-            elif key.startswith("sqr_sums__"):
-                key = key[len("sqr_sums__"):]
-                self.sqr_sums[key] = value
-        return self
+    def _from_sums(cls, columns, counts, sums, sqr_sums):
+        """Creates clusters from sums and sums of squares, as written by
+        earlier versions."""
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            means = numpy.where(counts > 0, sums / counts, 0.0)
+        m2s = numpy.maximum(sqr_sums - counts * means**2, 0.0)
+        return cls(columns, counts, means, m2s)
 
     @classmethod
-    def from_row(cls, row):
-        self = cls()
-        self += row
-        return self
-
-    def _add_col(self, name):
-        if name not in self.counts:
-            self.counts[name] = 0.0
-            self.sums[name] = 0.0
-            self.sqr_sums[name] = 0.0
-
-    def __iadd__(self, other):
-        if isinstance(other, Cluster):
-            for key in other.counts.iterkeys():
-                self._add_col(key)
-                self.counts[key] += other.counts[key]
-                self.sums[key] += other.sums[key]
-                self.sqr_sums[key] += other.sqr_sums[key]
-
-        else:
-            for key, value in other.iteritems():
+    def from_rows(cls, rows):
+        """Creates one cluster per row, treating NaN as a missing value
+        like from_source_records(). Datetimes are converted to seconds
+        since the epoch, and values that are not numbers are left out."""
+        columns = {}
+        length = 0
+        for index, row in enumerate(rows):
+            length = index + 1
+            for key, value in row.iteritems():
                 if isinstance(value, datetime.datetime):
                     value = float(value.strftime("%s"))
                 if not isinstance(value, (int, float, bool)): continue
-                self._add_col(key)
-                self.counts[key] += 1.0
-                self.sums[key] += value
-                self.sqr_sums[key] += value**2
-        return self
-
-    def get_cluster_row(self):
-        res = {}
-        for key in self.counts.iterkeys():
-            res['counts__' + key] = self.counts[key]
-            res['sums__' + key] = self.sums[key]
-            res['sqr_sums__' + key] = self.sqr_sums[key]
+                if key not in columns:
+                    columns[key] = array.array("d")
+                _append_at(columns[key], index, value, numpy.nan)
+        names = sorted(columns.iterkeys())
+        records = numpy.empty((length, len(names)))
+        for col, name in enumerate(names):
+            records[:, col] = _to_column(columns.pop(name), length, numpy.nan)
+        return cls.from_source_records(names, records)
+
+    @classmethod
+    def from_cluster_rows(cls, rows):
+        """Creates one cluster per cluster row. Also reads cluster rows
+        holding sums__X and sqr_sums__X instead of means__X and m2s__X,
+        as written by earlier versions."""
+        stat_names = cls.stat_names + ("sums", "sqr_sums")
+        prefixes = [(stat + "__", pos) for pos, stat in enumerate(stat_names)]
+        columns = {}
+        length = 0
+        for index, row in enumerate(rows):
+            length = index + 1
+            for key, value in row.iteritems():
+                for prefix, pos in prefixes:
+                    if key.startswith(prefix):
+                        key = key[len(prefix):]
+                        if key not in columns:
+                            columns[key] = tuple(array.array("d") for stat in stat_names)
+                        _append_at(columns[key][pos], index, value)
+                        break
+        if any(len(stats[3]) for stats in columns.itervalues()):
+            sums = cls._from_columns(length, dict((key, (stats[0], stats[3], stats[4]))
+                                                  for key, stats in columns.iteritems()))
+            return cls._from_sums(sums.columns, sums.counts, sums.means, sums.m2s)
+        return cls._from_columns(length, dict((key, stats[:3]) for key, stats in columns.iteritems()))
+
+    @classmethod
+    def from_source_records(cls, columns, records):
+        """Creates one cluster per source record (see
+        utils.read_records), treating NaN as a missing value."""
+        present = ~numpy.isnan(records)
+        return cls(list(columns), present.astype(numpy.float64),
+                   numpy.where(present, records, 0.0), numpy.zeros(records.shape))
+
+    @classmethod
+    def from_cluster_records(cls, columns, records):
+        """Creates one cluster per record of a file written from
+        get_cluster_records()."""
+        names = sorted(set(col.split("__", 1)[1] for col in columns))
+        stats = dict((stat, numpy.zeros((records.shape[0], len(names))))
+                     for stat in cls.stat_names + ("sums", "sqr_sums"))
+        for pos, col in enumerate(columns):
+            stat, name = col.split("__", 1)
+            stats[stat][:, names.index(name)] = records[:, pos]
+        if any(col.startswith("sums__") for col in columns):
+            return cls._from_sums(names, stats["counts"], stats["sums"], stats["sqr_sums"])
+        return cls(names, *[stats[stat] for stat in cls.stat_names])
+
+    def get_cluster_records(self):
+        """Returns the columns and records for storing the clusters as
+        fixed width records, with the same column names as the cluster
+        rows."""
+        columns = [stat + "__" + name for stat in self.stat_names for name in self.columns]
+        return columns, numpy.hstack([getattr(self, stat) for stat in self.stat_names])
+
+    @classmethod
+    def concatenate(cls, sets):
+        """Stacks the clusters of several sets, which may have different
+        columns, into one set."""
+        columns = sorted(set(col for clusters in sets for col in clusters.columns))
+        stats = [numpy.zeros((sum(len(clusters) for clusters in sets), len(columns)))
+                 for stat in cls.stat_names]
+        start = 0
+        for clusters in sets:
+            end = start + len(clusters)
+            positions = [columns.index(col) for col in clusters.columns]
+            for stat, name in zip(stats, cls.stat_names):
+                stat[start:end, positions] = getattr(clusters, name)
+            start = end
+        return cls(columns, *stats)
+
+    def content_hash(self):
+        """Returns a hash of the columns and statistics of the
+        clusters."""
+        digest = hashlib.sha1(repr(self.columns))
+        for stat in self.stat_names:
+            digest.update(numpy.ascontiguousarray(getattr(self, stat)).data)
+        return digest.hexdigest()
+
+    def take(self, indices):
+        """Returns the clusters selected by indices, an array of
+        positions or a boolean mask."""
+        return ClusterSet(self.columns, *[getattr(self, stat)[indices] for stat in self.stat_names])
+
+    def get_means(self, column):
+        """Returns the mean of column for every cluster, NaN where it is
+        missing."""
+        if column not in self.columns:
+            return numpy.empty(len(self)) * numpy.nan
+        col = self.columns.index(column)
+        return numpy.where(self.counts[:, col] > 0, self.means[:, col], numpy.nan)
+
+    def group(self, groups):
+        """Merges clusters with the same group number. groups is an
+        array with one integer per cluster; the merged clusters are
+        returned ordered by group number.
+
+        Means are merged as deviations from the first cluster of each
+        group, and M2 as the M2 of the parts plus their squared
+        deviations from the merged mean (Chan et al.)."""
+        order = numpy.argsort(groups, kind="mergesort")
+        groups = groups[order]
+        if not len(groups):
+            return ClusterSet(self.columns)
+        first = numpy.concatenate(([True], groups[1:] != groups[:-1]))
+        starts = numpy.flatnonzero(first)
+        index = numpy.cumsum(first) - 1
+        counts = self.counts[order]
+        means = self.means[order]
+        anchors = means[starts]
+
+        group_counts = numpy.add.reduceat(counts, starts, axis=0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            group_means = anchors + numpy.add.reduceat(
+                counts * (means - anchors[index]), starts, axis=0) / group_counts
+        group_means[group_counts == 0] = 0.0
+        group_m2s = numpy.add.reduceat(
+            self.m2s[order] + counts * (means - group_means[index])**2, starts, axis=0)
+        return ClusterSet(self.columns, group_counts, group_means, group_m2s)
+
+    def get_cluster_rows(self):
+        counts = self.counts.tolist()
+        means = self.means.tolist()
+        m2s = self.m2s.tolist()
+        res = []
+        for cluster_counts, cluster_means, cluster_m2s in zip(counts, means, m2s):
+            row = {}
+            for key, count, mean, m2 in zip(self.columns, cluster_counts, cluster_means, cluster_m2s):
+                if count:
+                    row['counts__' + key] = count
+                    row['means__' + key] = mean
+                    row['m2s__' + key] = m2
+            res.append(row)
         return res
 
-    def get_row(self):
-        res = {}
-        for key in self.counts.iterkeys():            
-            res[key] = self.sums[key] / self.counts[key]
-            var = self.sqr_sums[key]/self.counts[key] - (self.sums[key]/self.counts[key])**2
-            # Handle overflow and precission underflow
-            if var < 0.0:
-                if var < -1.0e-5:
-                    continue
-                var = 0
-            res[key + "_stddev"] =  math.sqrt(var)
+    def get_rows(self):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            stddevs = numpy.sqrt(self.m2s / self.counts).tolist()
+        present = (self.counts > 0).tolist()
+        means = self.means.tolist()
+        res = []
+        for cluster in zip(present, means, stddevs):
+            row = {}
+            for key, is_present, mean, stddev in zip(self.columns, *cluster):
+                if is_present:
+                    row[key] = mean
+                    row[key + "_stddev"] = stddev
+            res.append(row)
         return res
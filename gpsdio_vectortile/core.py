@@ -5,32 +5,257 @@
 Core components for gpsdio_vectortile
 """
 
+import export
+import json
+import metrics
 import quad_tree
+import utils
 import click
+import vectortile
+
+
+def column_map_options(f):
+    f = click.option("--column", "columns", multiple=True, metavar="NAME=EXPR",
+                     help="Tile column computed from a python expression over the "
+                          "clustered row, e.g. seriesgroup='utils.bits2float(mmsi)'. "
+                          "May be given multiple times.")(f)
+    f = click.option("--column-map", type=click.File(), metavar="FILE",
+                     help="JSON file with an object mapping tile columns to python "
+                          "expressions.")(f)
+    return f
+
+
+def metrics_option(f):
+    return click.option("--metrics", "metrics_file", metavar="FILE",
+                        help="Append per stage timings, row and byte counts and peak RSS "
+                             "to this file as JSON lines. See vectortile-metrics-report.")(f)
+
+
+def pipeline_options(f):
+    f = click.option("--prefetch", type=click.IntRange(0), metavar="N",
+                     help="Number of leaf source files read ahead while a tile is clustered "
+                          "and encoded, with --workers 1. Defaults to the setting of the "
+                          "previous run (4).")(f)
+    f = click.option("--writer-threads", type=click.IntRange(0), metavar="N",
+                     help="Number of threads writing cluster and tile files in the "
+                          "background, with --workers 1; 0 writes them in turn. Defaults "
+                          "to the setting of the previous run (2).")(f)
+    f = click.option("--write-queue", type=click.IntRange(1), metavar="N",
+                     help="Number of files queued for the writer threads before tile "
+                          "generation waits. Defaults to the setting of the previous "
+                          "run (16).")(f)
+    return f
+
+
+def set_pipeline_options(tree, prefetch, writer_threads, write_queue):
+    if prefetch is not None:
+        tree.prefetch = prefetch
+    if writer_threads is not None:
+        tree.writer_threads = writer_threads
+    if write_queue is not None:
+        tree.write_queue_size = write_queue
+
+
+def get_columnMap(columnMap, column_map_file, columns):
+    """Returns columnMap updated with the --column-map and --column
+    options."""
+    columnMap = dict(columnMap)
+    if column_map_file is not None:
+        columnMap.update(json.load(column_map_file))
+    for column in columns:
+        if "=" not in column:
+            raise click.BadParameter("expected NAME=EXPR, got %s" % column, param_hint="--column")
+        name, expr = column.split("=", 1)
+        columnMap[name.strip()] = expr.strip()
+    for name, expr in columnMap.iteritems():
+        try:
+            quad_tree.Quadtree.compile_expression(expr)
+        except SyntaxError, e:
+            raise click.BadParameter("invalid expression for %s: %s" % (name, e), param_hint="--column")
+    return columnMap
+
+
+def parse_bbox(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        lonmin, latmin, lonmax, latmax = [float(v) for v in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("expected LONMIN,LATMIN,LONMAX,LATMAX, got %s" % value)
+    return vectortile.Bbox(lonmin, latmin, lonmax, latmax)
+
+
+def parse_quantiles(ctx, param, value):
+    if value is None or value == "none":
+        return value
+    try:
+        quantiles = sorted(float(v) for v in value.split(","))
+    except ValueError:
+        raise click.BadParameter("expected comma separated probabilities, got %s" % value)
+    if not all(0.0 <= q <= 1.0 for q in quantiles):
+        raise click.BadParameter("probabilities must be between 0 and 1")
+    return quantiles
 
 
 @click.command(name='vectortile-generate-tree')
 @click.argument("infile", metavar="INFILENAME")
+@click.option("--workers", type=int, default=1, metavar="N",
+              help="Number of processes to partition subtrees with.")
+@click.option("--resume", is_flag=True,
+              help="Continue an interrupted run from its journal.")
+@click.option("--store", metavar="FILE",
+              help="Keep node info, cluster rows and tiles in this SQLite file "
+                   "instead of in separate files per node.")
+@click.option("--record-format", type=click.Choice(["msgpack", "binary"]), default="msgpack",
+              help="Format of source and cluster files. binary uses fixed width "
+                   "records that are memory mapped instead of unpacked row by row.")
+@click.option("--duplicate-zoom", type=click.IntRange(0, 31), metavar="ZOOM",
+              help="Merge source rows in the same grid cell at this zoom level "
+                   "(e.g. 24 for about 2 m) into one cluster before clustering "
+                   "leaf tiles.")
+@click.option("--builder", type=click.Choice(["partition", "sort"]), default="partition",
+              help="partition splits source files a few zoom levels per pass. sort "
+                   "sorts all rows by quadkey with an external merge sort and writes "
+                   "each leaf once, reading and writing files sequentially only; it "
+                   "ignores --workers.")
+@click.option("--keep-columns", multiple=True, metavar="NAMES",
+              help="Comma separated source columns to keep in addition to those used "
+                   "by the column map, e.g. for --column options given to "
+                   "vectortile-generate-tiles later. May be given multiple times.")
+@click.option("--all-columns", is_flag=True,
+              help="Keep all numeric and datetime source columns.")
+@column_map_options
+@metrics_option
 @click.pass_context
-def gpsdio_vectortile_generate_tree(ctx, infile):
-    tree = quad_tree.Quadtree(infile)
-    tree.root.generate_tree()
-    tree.save()
+def gpsdio_vectortile_generate_tree(ctx, infile, workers, resume, store, record_format, duplicate_zoom,
+                                    builder, keep_columns, all_columns, column_map, columns, metrics_file):
+    columnMap = get_columnMap(quad_tree.Quadtree.columnMap, column_map, columns)
+    keep_columns = [name.strip() for value in keep_columns for name in value.split(",") if name.strip()]
+    quad_tree.Quadtree.generate(infile, workers, resume, columnMap=columnMap,
+                                store_filename=store, record_format=record_format,
+                                duplicate_zoom=duplicate_zoom, metrics_filename=metrics_file,
+                                project_columns=not all_columns, keep_columns=keep_columns or None,
+                                tree_builder=builder)
 
 
 @click.command(name='vectortile-generate-tiles')
+@click.option("--workers", type=int, default=1, metavar="N",
+              help="Number of processes to generate tiles with.")
+@click.option("--resume", is_flag=True,
+              help="Skip the tiles finished by an interrupted run.")
+@click.option("--time-buckets", type=click.Choice(["none"] + sorted(utils.time_bucket_units)),
+              help="Write one tile per node and time bucket, named START,END;BBOX, and "
+                   "list the buckets in the header. Defaults to the setting of the "
+                   "previous run.")
+@click.option("--link-duplicates", type=click.Choice(["none", "hard", "symbolic"]),
+              help="Hard or symbolic link tile files identical to one written before "
+                   "instead of writing them again. Symbolic links should only be used "
+                   "for tilesets that are not appended to. Defaults to the setting of "
+                   "the previous run.")
+@click.option("--quantiles", callback=parse_quantiles, metavar="P,...",
+              help="Add approximate quantiles of every column for these probabilities, "
+                   "e.g. 0.01,0.99, to the header, or none. Defaults to the setting of "
+                   "the previous run.")
+@click.option("--bbox", callback=parse_bbox, metavar="LONMIN,LATMIN,LONMAX,LATMAX",
+              help="Only generate the tiles overlapping this bbox, and their ancestors.")
+@click.option("--min-zoom", type=click.IntRange(0), metavar="ZOOM",
+              help="Only generate tiles at this zoom level and deeper, and their "
+                   "ancestors.")
+@click.option("--max-zoom", type=click.IntRange(0), metavar="ZOOM",
+              help="Only generate tiles at this zoom level and above.")
+@pipeline_options
+@column_map_options
+@metrics_option
 @click.pass_context
-def gpsdio_vectortile_generate_tiles(ctx):
+def gpsdio_vectortile_generate_tiles(ctx, workers, resume, time_buckets, link_duplicates, quantiles,
+                                     bbox, min_zoom, max_zoom, prefetch, writer_threads, write_queue,
+                                     column_map, columns, metrics_file):
+    """Generates the tiles of a generated tree. With --bbox, --min-zoom
+    or --max-zoom, only the selected tiles are generated, reusing the
+    cluster files of the other nodes."""
     tree = quad_tree.Quadtree.load()
-    tree.root.generate_tiles()
+    tree.metrics_filename = metrics_file
+    if time_buckets is not None:
+        tree.time_buckets = None if time_buckets == "none" else time_buckets
+    if link_duplicates is not None:
+        tree.tile_links = None if link_duplicates == "none" else link_duplicates
+    if quantiles is not None:
+        tree.quantiles = None if quantiles == "none" else quantiles
+    set_pipeline_options(tree, prefetch, writer_threads, write_queue)
+    tree.columnMap = get_columnMap(tree.columnMap, column_map, columns)
+    gridcodes = None
+    if bbox is not None or min_zoom is not None or max_zoom is not None:
+        gridcodes = tree.select_gridcodes(bbox, min_zoom, max_zoom)
+    tree.generate_tiles(workers, resume, gridcodes)
+
+@click.command(name='vectortile-append')
+@click.argument("infile", metavar="INFILENAME")
+@click.option("--workers", type=int, default=1, metavar="N",
+              help="Number of processes to generate tiles with.")
+@pipeline_options
+@metrics_option
+@click.pass_context
+def gpsdio_vectortile_append(ctx, infile, workers, prefetch, writer_threads, write_queue, metrics_file):
+    tree = quad_tree.Quadtree.load()
+    tree.metrics_filename = metrics_file
+    set_pipeline_options(tree, prefetch, writer_threads, write_queue)
+    tree.append(infile, workers)
     tree.save()
 
+
 @click.command(name='vectortile-generate-headers')
+@metrics_option
 @click.pass_context
-def gpsdio_vectortile_generate_headers(ctx):
-    tree = quad_tree.Quadtree.load()
+def gpsdio_vectortile_generate_headers(ctx, metrics_file):
+    tree = quad_tree.Quadtree.load(summary=True)
+    tree.metrics_filename = metrics_file
     tree.generate_header()
     tree.generate_workspace()
 
+
+@click.command(name='vectortile-metrics-report')
+@click.argument("metrics_file", metavar="FILE", type=click.File())
+@click.option("--top", type=int, default=10, metavar="N",
+              help="Number of slowest tiles to list.")
+@click.pass_context
+def gpsdio_vectortile_metrics_report(ctx, metrics_file, top):
+    """Summarizes a --metrics file: time, rows and bytes per stage and
+    the slowest tiles."""
+    click.echo(metrics.format_report(metrics.summarize(metrics.read(metrics_file), top)))
+
+
+@click.command(name='vectortile-export')
+@click.argument("out", metavar="OUT")
+@click.option("--format", "out_format", type=click.Choice(["dir", "tar"]), default="dir",
+              help="Write tiles to OUT/Z/X/Y[.gz|.br], or to a single tar archive OUT "
+                   "with the same member names.")
+@click.option("--compression", type=click.Choice(export.compressions), default="gzip",
+              help="brotli requires the brotli package.")
+@click.option("--level", type=int, metavar="N",
+              help="Compression level, 0-9 for gzip (default 6) and 0-11 for brotli "
+                   "(default 11).")
+@click.option("--workers", type=int, default=4, metavar="N",
+              help="Number of threads to compress and write tiles with.")
+@metrics_option
+@click.pass_context
+def gpsdio_vectortile_export(ctx, out, out_format, compression, level, workers, metrics_file):
+    """Writes precompressed copies of the generated tiles to OUT for
+    serving, lowest zoom levels first. Columns (X) count from 180 degrees
+    west and rows (Y) from the south pole; time sliced tiles are put
+    under a START,END directory per time extent."""
+    if compression == "brotli":
+        try:
+            import brotli
+        except ImportError:
+            raise click.ClickException("--compression brotli requires the brotli package")
+    if level is not None and compression in export.level_ranges:
+        low, high = export.level_ranges[compression]
+        if not low <= level <= high:
+            raise click.BadParameter("must be %s-%s for %s, got %s" % (low, high, compression, level),
+                                     param_hint="--level")
+    tree = quad_tree.Quadtree.load()
+    tree.metrics_filename = metrics_file
+    export.export(tree, out, out_format == "tar", compression, level, workers)
+
 if __name__ == '__main__':
     gpsdio_vectortile()
@@ -0,0 +1,181 @@
+"""
+Export of generated tiles for web serving
+"""
+
+import collections
+import cStringIO
+import gzip
+import os
+import shutil
+import tarfile
+import time
+from multiprocessing.pool import ThreadPool
+import utils
+
+
+compressions = ("gzip", "brotli", "none")
+extensions = {"gzip": ".gz", "brotli": ".br", "none": ""}
+default_levels = {"gzip": 6, "brotli": 11, "none": 0}
+level_ranges = {"gzip": (0, 9), "brotli": (0, 11)}
+
+
+def gridcode_to_zxy(gridcode):
+    """Returns the zoom level, column and row of a tile, counting
+    columns from 180 degrees west and rows from the south pole."""
+    x = y = 0
+    for digit in gridcode:
+        digit = int(digit)
+        x = 2 * x + (digit & 1)
+        y = 2 * y + (digit >> 1)
+    return len(gridcode), x, y
+
+
+def compress(data, compression, level):
+    if compression == "gzip":
+        buf = cStringIO.StringIO()
+        # mtime = 0 makes the output depend on data only
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=level, mtime=0) as f:
+            f.write(data)
+        return buf.getvalue()
+    if compression == "brotli":
+        import brotli
+        return brotli.compress(data, quality=level)
+    return data
+
+
+def iter_tiles(tree):
+    """Yields the export path, tile file name and store key of every
+    tile of tree, top down: all tiles of a zoom level before those of
+    the next. Time sliced tiles get a directory per time extent."""
+    extents = None
+    if tree.time_buckets is not None:
+        extents = tree.get_time_extents()
+    nodes = collections.deque([tree.root])
+    while nodes:
+        node = nodes.popleft()
+        path = "%s/%s/%s" % gridcode_to_zxy(str(node.bounds))
+        if extents is None:
+            yield path, node.tile_filename, str(node.bounds)
+        else:
+            for start, end in extents:
+                yield ("%s,%s/%s" % (start, end, path),
+                       node.get_time_tile_filename(start), node.get_time_tile_key(start))
+        if node.children:
+            nodes.extend(node.children)
+
+
+class Exporter(object):
+    """Compresses the tiles of a tree and writes them to a z/x/y
+    directory tree, or to a tar archive, using a pool of threads.
+    Tiles are read in the calling thread, in the order of
+    iter_tiles()."""
+
+    def __init__(self, tree, out, archive = False, compression = "gzip", level = None, workers = 4):
+        self.tree = tree
+        self.out = out
+        self.archive = archive
+        self.compression = compression
+        self.level = default_levels[compression] if level is None else level
+        self.workers = workers
+        self.tiles = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.compress_seconds = 0.0
+
+    def read_tile(self, filename, key):
+        if self.tree.store is not None:
+            return self.tree.store.read_tile(key)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return f.read()
+
+    def export_tile(self, path, data):
+        """Compresses data, and unless writing an archive writes it to
+        path. Returns (path, data, compressed data or None, seconds
+        spent compressing)."""
+        start = time.time()
+        compressed = compress(data, self.compression, self.level)
+        seconds = time.time() - start
+        if self.archive:
+            return path, data, compressed, seconds
+        name = os.path.join(self.out, path)
+        if not os.path.isdir(os.path.dirname(name)):
+            try:
+                os.makedirs(os.path.dirname(name))
+            except OSError:
+                # Made by another thread
+                pass
+        if not utils.same_content(name, compressed):
+            with utils.atomic_open(name) as f:
+                f.write(compressed)
+        return path, data, len(compressed), seconds
+
+    def add_result(self, tar, result):
+        path, data, compressed, seconds = result
+        if tar is not None:
+            info = tarfile.TarInfo(path)
+            info.size = len(compressed)
+            tar.addfile(info, cStringIO.StringIO(compressed))
+            compressed = len(compressed)
+        self.tiles += 1
+        self.size += len(data)
+        self.compressed_size += compressed
+        self.compress_seconds += seconds
+
+    def export(self):
+        extension = extensions[self.compression]
+        pool = ThreadPool(self.workers)
+        pending = collections.deque()
+        tar = None
+        if self.archive:
+            tar = tarfile.open(self.out + ".tmp", "w")
+        elif not os.path.isdir(self.out):
+            os.makedirs(self.out)
+        done = False
+        try:
+            for path, filename, key in iter_tiles(self.tree):
+                data = self.read_tile(filename, key)
+                if data is None:
+                    continue
+                pending.append(pool.apply_async(self.export_tile, (path + extension, data)))
+                while len(pending) > 4 * self.workers or (pending and pending[0].ready()):
+                    self.add_result(tar, pending.popleft().get())
+            while pending:
+                self.add_result(tar, pending.popleft().get())
+
+            for name in ("header", "workspace"):
+                if not os.path.exists(name):
+                    continue
+                if tar is not None:
+                    tar.add(name)
+                else:
+                    shutil.copy(name, os.path.join(self.out, name))
+            done = True
+        finally:
+            pool.terminate()
+            pool.join()
+            if tar is not None:
+                tar.close()
+                if not done:
+                    os.unlink(self.out + ".tmp")
+        if tar is not None:
+            os.rename(self.out + ".tmp", self.out)
+
+
+def export(tree, out, archive = False, compression = "gzip", level = None, workers = 4):
+    """Exports the tiles of tree to out, see Exporter, and prints the
+    total size before and after compression."""
+    start = time.time()
+    with tree.metrics.stage("export", out=out) as record:
+        exporter = Exporter(tree, out, archive, compression, level, workers)
+        exporter.export()
+        record["tiles"] = exporter.tiles
+        record["bytes_read"] = exporter.size
+        record["bytes_written"] = exporter.compressed_size
+        record["stages"]["compress"] = exporter.compress_seconds
+    print "Exported %s tiles to %s in %.1fs: %.1f MB, %.1f MB %s (%.0f%%) in %.1fs of compression" % (
+        exporter.tiles, out, time.time() - start,
+        exporter.size / 1e6, exporter.compressed_size / 1e6, compression,
+        100.0 * exporter.compressed_size / max(exporter.size, 1), exporter.compress_seconds)
+    return exporter
@@ -0,0 +1,212 @@
+"""
+Tree generation by external merge sort on quadkeys
+
+Instead of partitioning source files into ever smaller files (see
+QuadtreeNode.partition), every row is tagged with its quadkey at the
+deepest zoom level, rows are sorted in runs of tree.sort_run_size rows,
+and the runs are merged, at most tree.max_open_files at a time, into
+one sorted source file and a file of the sorted keys. In key order
+every node of the tree is a contiguous range of rows, so the tree is
+planned with binary searches in the memory mapped keys, and the leaf
+source files are written one after the other in a single pass over the
+sorted file. Files are only ever read and written sequentially.
+"""
+
+import heapq
+import itertools
+import os
+import msgpack
+import numpy
+import vectortile
+import metrics
+import utils
+
+
+buffer_size = 1 << 20
+batch_size = 10000
+
+keys_filename = "sort-keys.bin"
+sorted_filename = "sort-src.msg"
+
+
+def iter_batches(iterable, size = batch_size):
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_run(name, run):
+    """Yields (key, run, row) for the [key, row] pairs of a run file,
+    run making rows with the same key compare in run order."""
+    with open(name, "rb", buffer_size) as f:
+        for key, row in msgpack.Unpacker(f):
+            yield key, run, row
+
+
+def iter_merged(names):
+    return heapq.merge(*[iter_run(name, run) for run, name in enumerate(names)])
+
+
+def write_runs(node, zoom_level, run_size):
+    """Writes the rows of the source file of node, run_size rows at a
+    time, sorted by their quadkey at zoom_level, to run files of [key,
+    row] pairs. Rows without a position inside the world bbox are
+    dropped. Returns the run file names and the number of rows."""
+    lat_col = node.tree.latitude_col
+    lon_col = node.tree.longitude_col
+    names = []
+    count = 0
+    for rows in iter_batches(node.iter_source_rows(), run_size):
+        rows = [row for row in rows
+                if lat_col in row and lon_col in row
+                and -180.0 <= row[lon_col] < 180.0 and -90.0 <= row[lat_col] < 90.0]
+        keys = utils.quadkeys(numpy.array([row[lon_col] for row in rows], dtype=numpy.float64),
+                              numpy.array([row[lat_col] for row in rows], dtype=numpy.float64),
+                              zoom_level)
+        order = numpy.argsort(keys, kind="mergesort")
+        name = "sort-run-%s.msg" % len(names)
+        with utils.msgpack_open(name, "w") as f:
+            keys = keys[order].tolist()
+            order = order.tolist()
+            for start in xrange(0, len(order), batch_size):
+                f.write_many([keys[i], rows[j]] for i, j in
+                             enumerate(order[start:start + batch_size], start))
+        names.append(name)
+        count += len(rows)
+    return names, count
+
+
+def merge_runs(names, max_open):
+    """Merges runs max_open at a time until at most max_open are left.
+    Returns the remaining run file names and the number of passes."""
+    passes = 0
+    while len(names) > max_open:
+        merged = []
+        for start in range(0, len(names), max_open):
+            group = names[start:start + max_open]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            name = "sort-merge-%s-%s.msg" % (passes, len(merged))
+            with utils.msgpack_open(name, "w") as f:
+                for batch in iter_batches(iter_merged(group)):
+                    f.write_many([key, row] for key, run, row in batch)
+            for old in group:
+                os.unlink(old)
+            merged.append(name)
+        names = merged
+        passes += 1
+    return names, passes
+
+
+def write_sorted(names):
+    """Merges the runs into the sorted source file and the key file."""
+    with utils.msgpack_open(sorted_filename, "w") as f:
+        with utils.atomic_open(keys_filename) as keys_file:
+            for batch in iter_batches(iter_merged(names)):
+                f.write_many(row for key, run, row in batch)
+                numpy.array([key for key, run, row in batch], dtype="<i8").tofile(keys_file)
+
+
+def read_keys():
+    if not os.path.getsize(keys_filename):
+        return numpy.zeros(0, dtype="<i8")
+    return numpy.memmap(keys_filename, dtype="<i8", mode="r")
+
+
+def plan(node, keys, start, end, zoom_level, leaves, force_split = False):
+    """Creates the children of node, and recursively theirs, for the
+    rows start to end of the sorted keys at zoom_level, splitting
+    nodes the way QuadtreeNode.plan_children does. The leaves are
+    appended to leaves in key order."""
+    node.count = end - start
+    zoom = node.bounds.zoom_level
+    if zoom < zoom_level and (force_split or node.count > node.tree.max_count):
+        node.children = [node.__class__(node.tree, b) for b in node.bounds.get_children()]
+        base = utils.gridcode2quadkey(str(node.bounds)) << 2
+        shift = 2 * (zoom_level - zoom - 1)
+        ends = keys[start:end].searchsorted([(base + i) << shift for i in (1, 2, 3)]) + start
+        starts = [start] + ends.tolist()
+        ends = ends.tolist() + [end]
+        for child, child_start, child_end in zip(node.children, starts, ends):
+            plan(child, keys, child_start, child_end, zoom_level, leaves)
+    else:
+        node.children = None
+        leaves.append(node)
+
+
+def write_leaves(leaves):
+    """Writes the rows of the sorted source file to the source files of
+    leaves, which are in key order, one file at a time."""
+    with open(sorted_filename, "rb", buffer_size) as f:
+        rows = msgpack.Unpacker(f)
+        for leaf in leaves:
+            with open(leaf.source_filename, "w", buffer_size) as out:
+                if leaf.count:
+                    writer = leaf.tree.get_source_writer(out)
+                    for batch in iter_batches(itertools.islice(rows, leaf.count)):
+                        writer.write_many(batch)
+
+
+def generate_tree(root, max_zoom = None):
+    """Splits the source file of root into a subtree whose leaves hold
+    at most root.tree.max_count rows, or are at the max zoom level, like
+    QuadtreeNode.generate_tree() does by partitioning, but by sorting
+    the rows on their quadkeys."""
+    tree = root.tree
+    zoom_level = vectortile.TileBounds.maxzoom
+    if max_zoom is not None:
+        zoom_level = min(zoom_level, max_zoom)
+
+    print "Sorting %s (%s rows) by quadkey at zoom %s" % (root.bbox, root.count, zoom_level)
+
+    with tree.metrics.stage("sort", gridcode=str(root.bounds), rows=root.count) as record:
+        source_size = metrics.file_size(root.source_filename)
+        with tree.metrics.time("runs"):
+            names, count = write_runs(root, zoom_level, tree.sort_run_size)
+        runs = len(names)
+        try:
+            run_size = sum(metrics.file_size(name) for name in names)
+            with tree.metrics.time("merge"):
+                names, passes = merge_runs(names, tree.max_open_files)
+                write_sorted(names)
+        finally:
+            for name in names:
+                if os.path.exists(name):
+                    os.unlink(name)
+        try:
+            with tree.metrics.time("plan"):
+                leaves = []
+                # Like partition(), keep the count of all rows for root
+                root_count = root.count
+                plan(root, read_keys(), 0, count, zoom_level, leaves, force_split = True)
+                root.count = root_count
+            with tree.metrics.time("write"):
+                write_leaves(leaves)
+            sorted_size = metrics.file_size(sorted_filename)
+        finally:
+            for name in (sorted_filename, keys_filename):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+        print "Sorted %s rows in %s runs and %s merge passes into %s leaves" % (
+            count, runs, passes + 1, len(leaves))
+
+        record["runs"] = runs
+        record["merge_passes"] = passes + 1
+        record["leaves"] = len(leaves)
+        record["bytes_read"] = source_size + (passes + 1) * run_size + sorted_size
+        record["bytes_written"] = (passes + 1) * run_size + sorted_size + sum(
+            metrics.file_size(leaf.source_filename) for leaf in leaves)
+
+    if tree.journal is not None:
+        tree.journal.write({"type": "partition",
+                            "gridcode": str(root.bounds),
+                            "subtree": root.get_subtree(),
+                            "leaves": []})
+
+    if tree.remove:
+        os.unlink(root.source_filename)
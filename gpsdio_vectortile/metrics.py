@@ -0,0 +1,160 @@
+"""
+Per stage timings for the tree commands
+"""
+
+import contextlib
+import json
+import os
+import resource
+import time
+import utils
+
+
+class Metrics(object):
+    """Appends one JSON line per timed stage to a file, e.g. per
+    partitioned node or per generated tile. Lines are written with
+    utils.append_write(), so worker processes can share the file. With
+    name = None, stages are timed but nothing is written."""
+
+    def __init__(self, name = None):
+        self.name = name
+        self.current = None
+
+    def write(self, record):
+        if self.name is None:
+            return
+        utils.append_write(self.name, json.dumps(record, sort_keys=True) + "\n")
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """Times the with block and writes a record for it holding
+        fields, the time it took, the peak RSS of the process in kB, the
+        times and counts added by time() and add() inside the block, and
+        the name of the stage it is inside of, if any."""
+        record = dict(fields, stage=name, stages={}, pid=os.getpid(), start=time.time())
+        if self.current is not None:
+            record["parent"] = self.current["stage"]
+        parent, self.current = self.current, record
+        try:
+            yield record
+        finally:
+            self.current = parent
+        record["seconds"] = time.time() - record["start"]
+        record["maxrss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.write(record)
+
+    @contextlib.contextmanager
+    def time(self, name):
+        """Adds the time the with block takes to the time of the
+        substage name of the current stage."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                stages = self.current["stages"]
+                stages[name] = stages.get(name, 0.0) + time.time() - start
+
+    def add(self, name, value):
+        """Adds value to the count name of the current stage, e.g. rows
+        or bytes_read."""
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0) + value
+
+
+def file_size(name):
+    if not os.path.exists(name):
+        return 0
+    return os.path.getsize(name)
+
+
+def read(f):
+    """Returns the records of a metrics file, skipping a partially
+    written last line."""
+    records = []
+    for line in f:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    return records
+
+
+def summarize(records, top = 10):
+    """Aggregates metrics records into the total time, rows and bytes
+    per stage and substage, and the top slowest tiles. The time of
+    stages inside another stage, e.g. the tiles of a pipeline, is also
+    counted as nested, with the names of the enclosing stages as
+    parents."""
+    stages = {}
+
+    def add(name, seconds, record = {}):
+        stage = stages.setdefault(name, {"stage": name, "calls": 0, "seconds": 0.0,
+                                         "nested": 0.0, "parents": [],
+                                         "rows": 0, "bytes_read": 0, "bytes_written": 0})
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+        parent = record.get("parent")
+        if parent is not None:
+            stage["nested"] += seconds
+            if parent not in stage["parents"]:
+                stage["parents"].append(parent)
+        for key in ("rows", "bytes_read", "bytes_written"):
+            stage[key] += record.get(key, 0)
+
+    maxrss = 0
+    for record in records:
+        add(record["stage"], record["seconds"], record)
+        for name, seconds in record.get("stages", {}).iteritems():
+            add("%s.%s" % (record["stage"], name), seconds)
+        maxrss = max(maxrss, record.get("maxrss", 0))
+
+    tiles = [record for record in records if record["stage"] == "tile"]
+    tiles.sort(key=lambda record: record["seconds"], reverse=True)
+
+    # Pipelined runs count the tiles written after their own stage ended
+    # in the pipeline stage
+    counted = [record for record in records if record["stage"] in ("tile", "pipeline")]
+    tile_counts = dict((key, sum(record.get(key, 0) for record in counted))
+                       for key in ("tiles_cached", "tiles_unchanged", "tiles_linked"))
+
+    return {"stages": sorted(stages.itervalues(), key=lambda stage: stage["stage"]),
+            "slowest_tiles": tiles[:top],
+            "tile_counts": tile_counts,
+            "maxrss": maxrss}
+
+
+def format_report(summary):
+    lines = ["Stage breakdown:",
+             "  %-24s %8s %10s %6s %12s %10s %10s" % (
+                "stage", "calls", "seconds", "%", "rows", "MB read", "MB written")]
+    # Nested stages are already part of the time of their parents
+    total = sum(stage["seconds"] - stage.get("nested", 0.0)
+                for stage in summary["stages"] if "." not in stage["stage"])
+    for stage in summary["stages"]:
+        name = stage["stage"]
+        if stage.get("parents"):
+            name = "%s (in %s)" % (name, ", ".join(stage["parents"]))
+        line = "  %-24s %8s %10.2f %6.1f" % (
+            name, stage["calls"], stage["seconds"],
+            100.0 * stage["seconds"] / max(total, 1e-9))
+        if "." in stage["stage"]:
+            line = "    %-22s%s" % (stage["stage"].split(".", 1)[1], line[26:])
+        else:
+            line += " %12s %10.1f %10.1f" % (
+                stage["rows"], stage["bytes_read"] / 1e6, stage["bytes_written"] / 1e6)
+        lines.append(line)
+    lines.append("Peak RSS: %s kB" % summary["maxrss"])
+    lines.append("Tiles: %(tiles_cached)s encoded from cache, %(tiles_unchanged)s unchanged, "
+                 "%(tiles_linked)s linked" % summary["tile_counts"])
+    lines.append("")
+    lines.append("Slowest tiles:")
+    lines.append("  %-20s %10s %10s %10s  %s" % ("gridcode", "seconds", "rows", "clusters", "substages"))
+    for record in summary["slowest_tiles"]:
+        substages = ", ".join("%s %.2fs" % (name, seconds)
+                              for name, seconds in sorted(record.get("stages", {}).iteritems(),
+                                                          key=lambda item: item[1], reverse=True))
+        lines.append("  %-20s %10.2f %10s %10s  %s" % (
+                record.get("gridcode") or "(root)", record["seconds"],
+                record.get("rows", ""), record.get("clusters", ""), substages))
+    return "\n".join(lines)
@@ -0,0 +1,189 @@
+"""
+Process pool scheduling for the tree commands
+"""
+
+import multiprocessing
+import Queue
+import traceback
+import vectortile
+
+
+def _get_spec(tree):
+    journal_name = None
+    if tree.journal is not None:
+        journal_name = tree.journal.name
+    return tree.get_spec(), journal_name, tree.metrics_filename
+
+
+# The tree of the last spec loaded in this worker process, so that its
+# tile cache and store are reused by later tasks
+_loaded = None
+
+
+def _load_tree(spec):
+    global _loaded
+    import cPickle
+    import quad_tree
+    import utils
+    key = cPickle.dumps(spec, -1)
+    if _loaded is not None and _loaded[0] == key:
+        return _loaded[1]
+    spec, journal_name, metrics_filename = spec
+    tree = quad_tree.Quadtree.from_spec(spec)
+    tree.metrics_filename = metrics_filename
+    if journal_name is not None:
+        tree.journal = utils.Journal(journal_name)
+    _loaded = key, tree
+    return tree
+
+
+# Seconds between checks for dead worker processes
+poll_interval = 1.0
+
+
+def _get_result(pool, results, pids):
+    """Returns the next result put in results by a task of pool. A
+    worker process that dies, say killed for running out of memory,
+    takes its task with it, and the pool silently replaces it, so
+    raises an exception once the worker processes are not those of
+    pids anymore instead of waiting forever."""
+    while True:
+        try:
+            return results.get(timeout=poll_interval)
+        except Queue.Empty:
+            workers = pool._pool
+            if (set(worker.pid for worker in workers) != pids
+                or any(worker.exitcode is not None for worker in workers)):
+                raise Exception("A worker process died; use --resume to continue the run")
+
+
+def _partition(args):
+    spec, gridcode, count, max_zoom, force_split = args
+    try:
+        import quad_tree_node
+        tree = _load_tree(spec)
+        node = quad_tree_node.QuadtreeNode(tree, vectortile.TileBounds(gridcode), count)
+        leaves = node.partition(max_zoom, force_split)
+        return gridcode, node.get_subtree(), [str(leaf.bounds) for leaf in leaves], None
+    except Exception:
+        return gridcode, None, None, traceback.format_exc()
+
+
+def generate_tree(root, max_zoom, workers, leaves = None):
+    """Partitions the source file of root using a pool of worker
+    processes. Every leaf that needs partitioning further is handed to
+    the pool as soon as its source file has been written, and the
+    subtree it returns is attached to the tree in this process. leaves
+    continues an interrupted run as for QuadtreeNode.generate_tree()."""
+
+    spec = _get_spec(root.tree)
+    nodes = {str(root.bounds): root}
+    results = Queue.Queue()
+    pool = multiprocessing.Pool(workers)
+    pids = set(worker.pid for worker in pool._pool)
+
+    def submit(gridcode, force_split = False):
+        pool.apply_async(_partition,
+                         ((spec, gridcode, nodes[gridcode].count, max_zoom, force_split),),
+                         callback=results.put)
+
+    try:
+        if leaves is None:
+            submit(str(root.bounds), force_split = True)
+            running = 1
+        else:
+            nodes = dict((str(leaf.bounds), leaf) for leaf in leaves)
+            for gridcode in nodes:
+                submit(gridcode)
+            running = len(nodes)
+        while running:
+            gridcode, subtree, leaf_gridcodes, error = _get_result(pool, results, pids)
+            running -= 1
+            if error is not None:
+                raise Exception("Partitioning %s failed:\n%s" % (gridcode, error))
+            node = nodes.pop(gridcode)
+            node.set_subtree(subtree)
+            leaf_gridcodes = set(leaf_gridcodes)
+            for leaf in node.iter_nodes():
+                if str(leaf.bounds) in leaf_gridcodes:
+                    nodes[str(leaf.bounds)] = leaf
+                    submit(str(leaf.bounds))
+                    running += 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _generate_tile(args):
+    spec, gridcode, count, tile_hashes, child_gridcodes = args
+    try:
+        import quad_tree_node
+        tree = _load_tree(spec)
+        node = quad_tree_node.QuadtreeNode(
+            tree, vectortile.TileBounds(gridcode), count)
+        node.tile_hashes = tile_hashes
+        if child_gridcodes:
+            node.children = [quad_tree_node.QuadtreeNode(tree, vectortile.TileBounds(child_gridcode))
+                             for child_gridcode in child_gridcodes]
+        node.generate_tile()
+        return gridcode, (node.colsByName, node.tile_hashes), None
+    except Exception:
+        return gridcode, None, traceback.format_exc()
+
+
+def generate_tiles(root, workers, gridcodes = None):
+    """Generates the tiles of the subtree below root bottom up using a
+    pool of worker processes. A tile is scheduled as soon as the tiles
+    of all its children are done. Every node gets the same colsByName
+    and tile_hashes as a serial run would give it. gridcodes restricts
+    the nodes as for QuadtreeNode.generate_tiles()."""
+
+    spec = _get_spec(root.tree)
+    nodes = {}
+    parents = {}
+    pending = {}
+    for node in root.iter_nodes(gridcodes):
+        gridcode = str(node.bounds)
+        nodes[gridcode] = node
+        if node.children:
+            for child in node.children:
+                if gridcodes is None or str(child.bounds) in gridcodes:
+                    pending[gridcode] = pending.get(gridcode, 0) + 1
+                    parents[str(child.bounds)] = gridcode
+
+    results = Queue.Queue()
+    pool = multiprocessing.Pool(workers)
+    pids = set(worker.pid for worker in pool._pool)
+
+    def submit(gridcode):
+        node = nodes[gridcode]
+        child_gridcodes = None
+        if node.children:
+            child_gridcodes = [str(child.bounds) for child in node.children]
+        pool.apply_async(_generate_tile,
+                         ((spec, gridcode, node.count, node.tile_hashes, child_gridcodes),),
+                         callback=results.put)
+
+    try:
+        for gridcode in nodes:
+            if gridcode not in pending:
+                submit(gridcode)
+
+        infos = {}
+        while len(infos) < len(nodes):
+            gridcode, info, error = _get_result(pool, results, pids)
+            if error is not None:
+                raise Exception("Generating tile for %s failed:\n%s" % (gridcode, error))
+            infos[gridcode] = info
+            parent = parents.get(gridcode)
+            if parent is not None:
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    submit(parent)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for gridcode, (colsByName, tile_hashes) in infos.iteritems():
+        nodes[gridcode].colsByName = colsByName
+        nodes[gridcode].tile_hashes = tile_hashes
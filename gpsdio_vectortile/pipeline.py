@@ -0,0 +1,176 @@
+"""
+Pipelined tile generation in a single process
+
+Generating a tile reads its input, clusters it, and encodes and writes
+the tile, one step after the other. generate_tiles() overlaps these
+steps for the tiles of a subtree: the source files of the next leaves
+are read by tree.prefetch threads while the current tile is clustered
+and encoded, cluster and tile files are written by tree.writer_threads
+threads from a queue of at most tree.write_queue_size files, and parent
+tiles take the clusters of their children from memory instead of
+reading them back from the cluster files.
+"""
+
+import collections
+import Queue
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+
+class BackgroundWriter(object):
+    """Runs write jobs on a number of threads, taking them from a queue
+    of at most queue_size jobs; submit() blocks while the queue is
+    full. The callbacks of finished jobs, and those passed to after(),
+    are called in the submitting thread by poll()."""
+
+    def __init__(self, threads, queue_size):
+        self.jobs = Queue.Queue(queue_size)
+        self.results = Queue.Queue()
+        self.submitted = 0
+        self.pending = set()
+        # (number of jobs submitted before, callback) per after()
+        self.deferred = collections.deque()
+        self.max_depth = 0
+        self.wait_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.threads = [threading.Thread(target=self.run) for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            seq, fn, args, callback = job
+            start = time.time()
+            try:
+                result, error = fn(*args), None
+            except Exception:
+                result, error = None, traceback.format_exc()
+            self.results.put((seq, callback, result, error, time.time() - start))
+
+    def submit(self, fn, args, callback = None):
+        self.poll()
+        seq = self.submitted
+        self.submitted += 1
+        self.pending.add(seq)
+        start = time.time()
+        self.jobs.put((seq, fn, args, callback))
+        self.wait_seconds += time.time() - start
+        self.max_depth = max(self.max_depth, self.jobs.qsize())
+
+    def after(self, callback):
+        """Calls callback once all jobs submitted so far are done."""
+        self.deferred.append((self.submitted, callback))
+        self.poll()
+
+    def poll(self):
+        while True:
+            try:
+                seq, callback, result, error, seconds = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            self.pending.discard(seq)
+            self.busy_seconds += seconds
+            if error is not None:
+                raise Exception("Writing failed:\n%s" % error)
+            if callback is not None:
+                callback(result)
+        done = min(self.pending) if self.pending else self.submitted
+        while self.deferred and self.deferred[0][0] <= done:
+            self.deferred.popleft()[1]()
+
+    def close(self):
+        """Waits for all jobs and calls the remaining callbacks."""
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.poll()
+
+
+class Prefetched(object):
+    """The result of reading ahead on a thread pool; get() waits for it
+    and adds the time waited to waits[0]."""
+
+    def __init__(self, result, waits):
+        self.result = result
+        self.waits = waits
+
+    def get(self):
+        start = time.time()
+        try:
+            return self.result.get()
+        finally:
+            self.waits[0] += time.time() - start
+
+
+def iter_nodes_bottom_up(node, gridcodes = None):
+    """Yields node and its descendants, children before parents, in the
+    order QuadtreeNode.generate_tiles() generates their tiles."""
+    if gridcodes is not None and str(node.bounds) not in gridcodes:
+        return
+    if node.children:
+        for child in node.children:
+            for descendant in iter_nodes_bottom_up(child, gridcodes):
+                yield descendant
+    yield node
+
+
+def generate_tiles(root, gridcodes = None):
+    """Generates the tiles of the subtree below root like
+    QuadtreeNode.generate_tiles() with one worker does, with reads,
+    clustering and encoding, and writes overlapping. Records the time
+    spent waiting for reads and for room in the write queue, and the
+    largest queue depths, as a pipeline metrics stage."""
+    tree = root.tree
+    nodes = list(iter_nodes_bottom_up(root, gridcodes))
+    readers = None
+    if tree.prefetch:
+        readers = ThreadPool(tree.prefetch)
+    writer = None
+    if tree.writer_threads:
+        writer = BackgroundWriter(tree.writer_threads, tree.write_queue_size)
+
+    with tree.metrics.stage("pipeline", gridcode=str(root.bounds), tiles=len(nodes)) as record:
+        prefetched = {}
+        waits = [0.0]
+        max_reads = 0
+        next_read = 0
+        tree.writer = writer
+        tree.written_clusters = {}
+        try:
+            for index, node in enumerate(nodes):
+                while readers is not None and next_read < len(nodes) and len(prefetched) < tree.prefetch:
+                    ahead = nodes[next_read]
+                    if not ahead.children and ahead.count <= tree.max_count:
+                        prefetched[next_read] = Prefetched(
+                            readers.apply_async(ahead.read_source_clusters), waits)
+                    next_read += 1
+                max_reads = max(max_reads, len(prefetched))
+                node.generate_tile(prefetched.pop(index, None))
+            if writer is not None:
+                writer.close()
+        finally:
+            tree.writer = None
+            tree.written_clusters = None
+            if readers is not None:
+                readers.terminate()
+                readers.join()
+
+        record["read_wait"] = waits[0]
+        record["read_queue_max"] = max_reads
+        if writer is not None:
+            record["write_wait"] = writer.wait_seconds
+            record["write_queue_max"] = writer.max_depth
+            record["writer_busy"] = writer.busy_seconds
+
+    print "Pipeline: waited %.2fs for reads, at most %s of %s read ahead" % (
+        waits[0], max_reads, tree.prefetch)
+    if writer is not None:
+        print "Pipeline: waited %.2fs for the write queue, at most %s of %s queued, writers busy %.2fs" % (
+            writer.wait_seconds, writer.max_depth, tree.write_queue_size, writer.busy_seconds)
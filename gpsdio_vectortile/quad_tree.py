@@ -1,6 +1,14 @@
 import gpsdio
 import datetime
+import itertools
+import keyword
+import numpy
+import os
+import re
+import time
+import metrics
 import quad_tree_node
+import store
 import utils
 import json
 
@@ -9,10 +17,76 @@ class Quadtree(object):
     max_count = 16000
     remove = True
 
+    # A leaf getting at least this fraction of the rows of the node
+    # being partitioned is split further in the same partition
+    skew_fraction = 0.9
+    # If set, source rows in the same grid cell at this zoom level are
+    # merged into one cluster before clustering leaf tiles
+    duplicate_zoom = None
+
+    ingest_batch_size = 10000
+
+    partition_levels = 8
+    max_open_files = 64
+    # Rows routed to leaf source files are buffered in memory and
+    # written route_buffer_size rows at a time, see utils.WriterCache
+    route_buffer_size = 100000
+
+    # "partition" or "sort", see QuadtreeNode.generate_tree; the sort
+    # builder sorts sort_run_size rows at a time
+    tree_builder = "partition"
+    sort_run_size = 1000000
+
     clustering_levels = 6
+    chunk_size = 100000
+
+    record_format = "msgpack"
+    source_columns = None
+
+    # Ingest only the columns used by columnMap (see
+    # get_ingest_columns), plus keep_columns
+    project_columns = True
+    keep_columns = None
+
+    store_filename = None
+    _store = None
+
+    # Number of encoded tiles kept to skip encoding identical tiles
+    tile_cache_size = 64
+    _tile_cache = None
+    # None, "hard" or "symbolic": link tile files identical to one
+    # written before to it instead of writing them
+    tile_links = None
+
+    journal = None
+    metrics_filename = None
+    _metrics = None
+    tree_journal_filename = "tree-journal.msg"
+    tiles_journal_filename = "tiles-journal.msg"
+    summary_filename = "summary.msg"
+
+    # None, or a list of probabilities, e.g. [0.01, 0.99], to add
+    # approximate quantiles of every column to the header
+    quantiles = None
+
+    # Serial tile generation reads the source files of up to prefetch
+    # leaves ahead and writes files on writer_threads threads from a
+    # queue of up to write_queue_size files, see pipeline
+    prefetch = 4
+    writer_threads = 2
+    write_queue_size = 16
+    # The pipeline.BackgroundWriter, and the clusters of written tiles
+    # not yet read by their parents, while a pipeline runs
+    writer = None
+    written_clusters = None
 
     latitude_col = "lat"
     longitude_col = "lon"
+    time_col = "timestamp"
+
+    # None, or one of the keys of utils.time_bucket_units to write one
+    # tile per node and year, month, week or day
+    time_buckets = None
 
     columnMap = {
         "datetime": "timestamp",
@@ -24,12 +98,77 @@ class Quadtree(object):
         "seriesgroup": "utils.bits2float(mmsi)"
         }
 
+    _compiled_columnMap = None
+    _compiled_columnMap_source = None
+
+    @staticmethod
+    def compile_expression(expr):
+        """Returns (name, None) if expr just names a column, and (None,
+        code) for other expressions. Raises SyntaxError for invalid
+        expressions."""
+        expr = expr.strip()
+        if (re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", expr)
+            and not keyword.iskeyword(expr)
+            and expr not in ("None", "True", "False")
+            and expr not in globals()):
+            return expr, None
+        return None, compile(expr, "<columnMap>", "eval")
+
+    @property
+    def compiled_columnMap(self):
+        """self.columnMap as a list of (key, name, code) with the
+        expressions compiled once. Recompiled if self.columnMap is
+        replaced."""
+        if self._compiled_columnMap_source is not self.columnMap:
+            self._compiled_columnMap = [
+                (key,) + self.compile_expression(expr)
+                for key, expr in self.columnMap.iteritems()]
+            self._compiled_columnMap_source = self.columnMap
+        return self._compiled_columnMap
+
+    @staticmethod
+    def get_code_names(code):
+        """Returns the names used by code, including those used by
+        nested code such as generator expressions."""
+        names = set(code.co_names) | set(code.co_varnames) | set(code.co_freevars)
+        for const in code.co_consts:
+            if hasattr(const, "co_names"):
+                names |= Quadtree.get_code_names(const)
+        return names
+
+    def get_ingest_columns(self):
+        """Returns the set of source columns to ingest: those used by
+        self.columnMap, with X for X_stddev, the latitude, longitude and
+        time columns and self.keep_columns. Returns None, to ingest all
+        columns, if self.project_columns is False or an expression uses
+        row."""
+        if not self.project_columns:
+            return None
+        columns = set([self.latitude_col, self.longitude_col, self.time_col])
+        columns.update(self.keep_columns or [])
+        for key, name, code in self.compiled_columnMap:
+            names = [name] if code is None else self.get_code_names(code)
+            if "row" in names:
+                return None
+            for name in names:
+                columns.add(name)
+                if name.endswith("_stddev"):
+                    columns.add(name[:-len("_stddev")])
+        return columns
+
+    @property
+    def columnMap_hash(self):
+        return repr(sorted(self.columnMap.iteritems()))
+
     def map_row(self, row):
         row['row'] = row
         out_row = {}
-        for key, expr in self.columnMap.iteritems():
+        for key, name, code in self.compiled_columnMap:
+            if code is None:
+                out_row[key] = row.get(name)
+                continue
             try:
-                value = eval(expr, globals(), row)
+                value = eval(code, globals(), row)
             except Exception, e:
                 value = None
             out_row[key] = value
@@ -44,62 +183,378 @@ class Quadtree(object):
         if __bare__: return
 
         self.root = quad_tree_node.QuadtreeNode(self)
+        self.root.count = self.ingest(filename, self.root.source_filename)
+
+    @classmethod
+    def generate(cls, filename, workers = 1, resume = False, **kw):
+        """Ingests filename and generates the tree, like
+        Quadtree(filename).root.generate_tree() followed by save().
+        Progress is journaled, and with resume = True, an interrupted
+        run continues from its journal instead of starting over."""
+        self = cls(filename, __bare__ = True, **kw)
+        self.root = quad_tree_node.QuadtreeNode(self)
+        self.journal = utils.Journal(self.tree_journal_filename)
+        records = []
+        if resume:
+            records = self.journal.read()
+        else:
+            self.journal.clear()
+            if os.path.exists(self.summary_filename):
+                os.unlink(self.summary_filename)
+
+        ingested = [record for record in records if record["type"] == "ingest"]
+        if ingested:
+            self.root.count = ingested[0]["count"]
+            self.source_columns = ingested[0].get("source_columns")
+        else:
+            self.root.count = self.ingest(filename, self.root.source_filename)
+            self.journal.write({"type": "ingest", "count": self.root.count,
+                                "source_columns": self.source_columns})
+
+        self.root.generate_tree(workers = workers, nodes = self.root.replay_partitions(records))
+        self.save()
+        self.journal.clear()
+        self.journal = None
+        return self
+
+    def select_gridcodes(self, bbox = None, min_zoom = None, max_zoom = None):
+        """Returns the gridcodes of the nodes whose tiles overlap bbox, a
+        vectortile.Bbox, and whose zoom level is between min_zoom and
+        max_zoom, together with the gridcodes of their ancestors, whose
+        tiles are made from theirs."""
+        gridcodes = set()
+        for node in self.root.iter_nodes():
+            zoom = node.bounds.zoom_level
+            if min_zoom is not None and zoom < min_zoom:
+                continue
+            if max_zoom is not None and zoom > max_zoom:
+                continue
+            if bbox is not None and not (node.bbox.lonmin < bbox.lonmax and bbox.lonmin < node.bbox.lonmax and
+                                         node.bbox.latmin < bbox.latmax and bbox.latmin < node.bbox.latmax):
+                continue
+            gridcodes.add(str(node.bounds))
+            gridcodes.update(str(ancestor) for ancestor in node.bounds.get_ancestors())
+        return gridcodes
+
+    def generate_tiles(self, workers = 1, resume = False, gridcodes = None):
+        """Generates all tiles and saves the tree. Finished tiles are
+        journaled, and with resume = True, the tiles finished by an
+        interrupted run are not generated again.
+
+        If gridcodes is given, e.g. from select_gridcodes(), only the
+        tiles of those nodes are generated, reusing the cluster files of
+        the other nodes. It must contain the ancestors of every node in
+        it."""
+        self.journal = utils.Journal(self.tiles_journal_filename)
+        if resume:
+            done = {}
+            for record in self.journal.read():
+                if record["type"] == "tile":
+                    done[record["gridcode"]] = record
+            selected = gridcodes
+            gridcodes = set()
+            for node in self.root.iter_nodes():
+                gridcode = str(node.bounds)
+                if gridcode in done:
+                    node.colsByName = done[gridcode]["colsByName"]
+                    node.tile_hashes = done[gridcode].get("tile_hashes", {})
+                elif selected is None or gridcode in selected:
+                    gridcodes.add(gridcode)
+            print "Resuming with %s of %s tiles done" % (len(done), len(done) + len(gridcodes))
+        else:
+            self.journal.clear()
+        if gridcodes is not None:
+            print "Generating %s of %s tiles" % (
+                len(gridcodes), sum(1 for node in self.root.iter_nodes()))
+        self.root.generate_tiles(workers, gridcodes)
+        self.save()
+        self.write_summary()
+        self.journal.clear()
+        self.journal = None
+
+    @staticmethod
+    def get_value_kind(value):
+        if isinstance(value, datetime.datetime):
+            return "timestamp"
+        if isinstance(value, (float, int, bool)):
+            return "numeric"
+        return "skip"
+
+    def ingest(self, filename, source_filename):
+        """Writes the numeric and datetime columns of every row of
+        filename to source_filename, self.ingest_batch_size rows at a
+        time, and returns the number of rows. Only the columns returned
+        by get_ingest_columns() are kept. Datetimes are converted to
+        milliseconds since the epoch for a whole batch at once."""
 
         print "Loading data..."
 
-        with utils.msgpack_open(self.root.source_filename, "w") as outf:
-            with gpsdio.open(filename) as f:
-                for row in f:
-                    out_row = {}
-                    for key, value in row.iteritems():
-                        if isinstance(value, datetime.datetime):
-                            value = float(value.strftime("%s")) * 1000.0
-                        if not isinstance(value, (float, int, bool)):
-                            continue
-                        out_row[key] = value
-                    outf.write(out_row)
-                    self.root.count += 1
+        start = time.time()
+        kinds = {}
+        count = 0
+        columns = self.get_ingest_columns()
+        if columns is not None:
+            columns = sorted(columns)
+        with self.metrics.stage("ingest", filename=filename, columns=columns) as record:
+            with utils.msgpack_open(source_filename, "w") as outf:
+                with gpsdio.open(filename) as f:
+                    while True:
+                        with self.metrics.time("read"):
+                            rows = list(itertools.islice(f, self.ingest_batch_size))
+                        if not rows:
+                            break
+                        with self.metrics.time("convert"):
+                            out_rows = []
+                            timestamps = []
+                            timestamp_cells = []
+                            for row in rows:
+                                out_row = {}
+                                if columns is None:
+                                    items = row.iteritems()
+                                else:
+                                    items = [(key, row[key]) for key in columns if key in row]
+                                for key, value in items:
+                                    kind = kinds.get((key, value.__class__))
+                                    if kind is None:
+                                        kind = kinds[(key, value.__class__)] = self.get_value_kind(value)
+                                    if kind == "numeric":
+                                        out_row[key] = value
+                                    elif kind == "timestamp":
+                                        timestamps.append(value)
+                                        timestamp_cells.append((out_row, key))
+                                out_rows.append(out_row)
+                            if timestamps:
+                                millis = numpy.array(timestamps, dtype="datetime64[us]").astype(numpy.int64) / 1000.0
+                                for (out_row, key), value in zip(timestamp_cells, millis.tolist()):
+                                    out_row[key] = value
+                        with self.metrics.time("write"):
+                            outf.write_many(out_rows)
+                        count += len(out_rows)
+            record["rows"] = count
+            record["bytes_read"] = metrics.file_size(filename)
+            record["bytes_written"] = metrics.file_size(source_filename)
+
+        self.source_columns = sorted(
+            set(self.source_columns or []) |
+            set(key for (key, cls), kind in kinds.iteritems() if kind != "skip"))
+
+        elapsed = time.time() - start
+        print "Loaded %s rows in %.1fs (%.0f rows/s)" % (
+            count, elapsed, count / max(elapsed, 1e-6))
+        if columns is not None:
+            print "Kept columns %s" % ", ".join(self.source_columns)
+        return count
+
+    def get_source_writer(self, file):
+        """Returns a writer for the source file of a node below the
+        root, in self.record_format."""
+        if self.record_format == "binary":
+            return utils.RecordWriter(file, self.source_columns)
+        return utils.Writer(file)
 
+    @property
+    def max_zoom(self):
+        if self.max_depth is None:
+            return None
+        return self.root.bounds.zoom_level + self.max_depth
+
+    def append(self, filename, workers = 1):
+        """Adds the rows of filename to a generated tree, splitting
+        leaves that grow beyond self.max_count, and regenerates only the
+        tiles of the leaves that got new rows and their ancestors."""
+        source_filename = "append-src.msg"
+        count = self.ingest(filename, source_filename)
+        with self.metrics.stage("add_rows", filename=filename, rows=count):
+            gridcodes = self.root.add_rows(source_filename, self.max_zoom)
+        os.unlink(source_filename)
+        self.root.generate_tiles(workers, gridcodes)
+        self.write_summary()
+
+
+    @property
+    def store(self):
+        """The store.SqliteStore holding node info, cluster rows and
+        tiles if self.store_filename is set, else None, in which case
+        they are kept in one file each per node."""
+        if self.store_filename is None:
+            return None
+        if self._store is None:
+            self._store = store.SqliteStore(self.store_filename)
+        return self._store
+
+    @property
+    def tile_cache(self):
+        """A utils.LRUCache of encoded tiles and their column ranges,
+        shared by all nodes."""
+        if self._tile_cache is None:
+            self._tile_cache = utils.LRUCache(self.tile_cache_size)
+        return self._tile_cache
+
+    @property
+    def pipelined(self):
+        """Whether serial tile generation uses pipeline. Not with a
+        store, as its connection belongs to one thread."""
+        return self.store_filename is None and bool(self.prefetch or self.writer_threads)
+
+    def submit_write(self, fn, args, callback = None):
+        """Calls fn(*args), which writes a file, and then callback, if
+        given, with its result. While a pipeline runs, fn is run by its
+        background writer instead, and callback is called later, in this
+        thread."""
+        if self.writer is not None:
+            self.writer.submit(fn, args, callback)
+            return
+        with self.metrics.time("write"):
+            result = fn(*args)
+        if callback is not None:
+            callback(result)
+
+    def after_writes(self, callback):
+        """Calls callback once all files submitted so far are written."""
+        if self.writer is not None:
+            self.writer.after(callback)
+        else:
+            callback()
+
+    @property
+    def metrics(self):
+        """A metrics.Metrics recording stage timings to
+        self.metrics_filename. It only times stages and records nothing
+        if that is None."""
+        if self._metrics is None or self._metrics.name != self.metrics_filename:
+            self._metrics = metrics.Metrics(self.metrics_filename)
+        return self._metrics
 
     @property
     def name(self):
         return self.filename.split(".")[0]
 
+    def get_spec(self):
+        return {"max_depth": self.max_depth,
+                "max_count": self.max_count,
+                "remove": self.remove,
+                "clustering_levels": self.clustering_levels,
+                "columnMap": self.columnMap,
+                "chunk_size": self.chunk_size,
+                "partition_levels": self.partition_levels,
+                "max_open_files": self.max_open_files,
+                "route_buffer_size": self.route_buffer_size,
+                "tree_builder": self.tree_builder,
+                "sort_run_size": self.sort_run_size,
+                "store_filename": self.store_filename,
+                "record_format": self.record_format,
+                "source_columns": self.source_columns,
+                "project_columns": self.project_columns,
+                "keep_columns": self.keep_columns,
+                "time_buckets": self.time_buckets,
+                "skew_fraction": self.skew_fraction,
+                "duplicate_zoom": self.duplicate_zoom,
+                "tile_cache_size": self.tile_cache_size,
+                "tile_links": self.tile_links,
+                "quantiles": self.quantiles,
+                "prefetch": self.prefetch,
+                "writer_threads": self.writer_threads,
+                "write_queue_size": self.write_queue_size,
+                "filename": self.filename,
+                }
+
+    @classmethod
+    def from_spec(cls, spec):
+        spec = dict(spec)
+        return cls(spec.pop("filename"), __bare__ = True, **spec)
+
     def save(self):
         with utils.msgpack_open("tree.msg", "w") as f:
-            f.write({"max_depth": self.max_depth,
-                     "max_count": self.max_count,
-                     "remove": self.remove,
-                     "clustering_levels": self.clustering_levels,
-                     "filename": self.filename,
-                     })
+            f.write(self.get_spec())
         self.root.save()
 
     @classmethod
-    def load(cls):
+    def load(cls, summary = False):
+        """Loads a saved tree. With summary = True, only the count and
+        colsByName of the root are loaded, from the summary written by
+        generate_tiles(), if there is one, which takes constant time."""
         with utils.msgpack_open("tree.msg") as f:
             spec = f.next()
-        self = cls(spec.pop("filename"), __bare__ = True, **spec)
+        self = cls.from_spec(spec)
         self.root = quad_tree_node.QuadtreeNode(self)
-        self.root.load()
+        root_summary = self.read_summary() if summary else None
+        if root_summary is not None:
+            self.root.count = root_summary["count"]
+            self.root.colsByName = root_summary["colsByName"]
+        else:
+            self.root.load()
         return self
 
+    def read_summary(self):
+        if not os.path.exists(self.summary_filename):
+            return None
+        with utils.msgpack_open(self.summary_filename) as f:
+            return f.next()
+
+    def write_summary(self):
+        """Writes the count and colsByName of the root to
+        self.summary_filename. If self.quantiles is set, approximate
+        quantiles of every column are added, computed from the clusters
+        of the root tile weighted by their row counts rather than from
+        the rows themselves."""
+        summary = {"count": self.root.count,
+                   "colsByName": self.root.colsByName,
+                   "quantiles": None}
+        if self.quantiles:
+            clusters = self.root.read_clusters()
+            weights = clusters.counts.max(axis=1) if clusters.columns else []
+            data = [self.map_row(row) for row in clusters.get_rows()]
+            summary["quantiles"] = {}
+            for name in self.columnMap:
+                values = [numpy.nan if row[name] is None else row[name] for row in data]
+                try:
+                    quantiles = utils.weighted_quantiles(values, weights, self.quantiles)
+                except (TypeError, ValueError):
+                    continue
+                if quantiles is not None:
+                    summary["quantiles"][name] = dict(zip(self.quantiles, quantiles))
+        with utils.msgpack_open(self.summary_filename, "w") as f:
+            f.write(summary)
 
 
+
+    def get_time_extents(self):
+        """Returns the [start, end] in milliseconds of every time bucket
+        that has any rows."""
+        clusters = self.root.read_clusters()
+        return [list(self.root.get_time_extent(bucket))
+                for bucket, indices in self.root.iter_time_buckets(clusters)
+                if bucket is not None]
+
     def generate_header(self):
-        with open("header", "w") as f:
-            f.write(json.dumps(
-                    {"colsByName": self.root.colsByName,
-                     "seriesTilesets": False,
-                     "tilesetName": self.name,
-                     "tilesetVersion": "0.0.1"
-                     }))
+        header = {"colsByName": self.root.colsByName,
+                  "seriesTilesets": False,
+                  "tilesetName": self.name,
+                  "tilesetVersion": "0.0.1"
+                  }
+        with self.metrics.stage("header"):
+            root_summary = self.read_summary()
+            if root_summary is not None and root_summary["quantiles"]:
+                colsByName = {}
+                for name, col in self.root.colsByName.iteritems():
+                    col = dict(col)
+                    quantiles = root_summary["quantiles"].get(name)
+                    if quantiles:
+                        # Keyed by probability, e.g. "0.99"
+                        col["quantiles"] = dict((repr(p), value) for p, value in quantiles.iteritems())
+                    colsByName[name] = col
+                header["colsByName"] = colsByName
+            if self.time_buckets is not None:
+                # Tiles are named "start,end;bbox" for every extent
+                header["temporalExtents"] = self.get_time_extents()
+            with utils.atomic_open("header") as f:
+                f.write(json.dumps(header))
 
     def generate_workspace(self):
-        time = datetime.datetime.fromtimestamp((self.root.colsByName['datetime']['min'] + self.root.colsByName['datetime']['max']) / 2.0 / 1000.0).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        time = datetime.datetime.utcfromtimestamp((self.root.colsByName['datetime']['min'] + self.root.colsByName['datetime']['max']) / 2.0 / 1000.0).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
         timeExtent = (self.root.colsByName['datetime']['max'] - self.root.colsByName['datetime']['min']) / 10
 
-        with open("workspace", "w") as f:
+        with utils.atomic_open("workspace") as f:
             f.write(json.dumps(
                     {
                         "state": {
@@ -1,7 +1,16 @@
 import vectortile
 import datetime
+import hashlib
+import itertools
+import json
+import numpy
 import os.path
+import resource
 import cluster as cluster_mod
+import external_sort
+import metrics
+import parallel
+import pipeline
 import utils
 
 class QuadtreeNode(object):
@@ -11,15 +20,29 @@ class QuadtreeNode(object):
         self.bbox = self.bounds.get_bbox()
         self.count = count
         self.colsByName = colsByName or {}
+        # [sha1, inode, mtime] of the tile files written for this node
+        # by tile file name, see write_tile_data()
+        self.tile_hashes = {}
         self.children = None
 
 
+    @property
+    def binary_source(self):
+        """Whether the source file holds fixed width records rather than
+        msgpack rows. The root source file is always msgpack, as it is
+        written while the columns are still being discovered."""
+        return self.tree.record_format == "binary" and self.bounds.zoom_level > 0
+
     @property
     def source_filename(self):
+        if self.binary_source:
+            return "%s-src.bin" % self.bounds
         return "%s-src.msg" % self.bounds
 
     @property
     def cluster_filename(self):
+        if self.tree.record_format == "binary":
+            return "%s-cluster.bin" % self.bounds
         return "%s-cluster.msg" % self.bounds
 
     @property
@@ -30,21 +53,52 @@ class QuadtreeNode(object):
     def tile_filename(self):
         return "%s" % self.bbox
 
+    def get_time_extent(self, bucket):
+        """Returns the (start, end) in milliseconds of a time bucket."""
+        return bucket, utils.time_bucket_end(bucket, self.tree.time_buckets)
+
+    def get_time_tile_filename(self, bucket):
+        """The file name of the tile of this node for one time bucket:
+        the time extent of the bucket and the bbox of the node."""
+        return "%s,%s;%s" % (self.get_time_extent(bucket) + (self.bbox,))
+
+    def get_time_tile_key(self, bucket):
+        """The key of the tile of this node for one time bucket in
+        self.tree.store."""
+        return "%s,%s;%s" % (self.get_time_extent(bucket) + (self.bounds,))
+
     def save(self):
+        if self.tree.store is not None:
+            self.tree.store.write_infos([(str(node.bounds), node.count, node.colsByName)
+                                         for node in self.iter_nodes()])
+            return
         with utils.msgpack_open(self.info_filename, "w") as f:
             f.write({"bounds": str(self.bounds),
                      "count": self.count,
-                     "colsByName": self.colsByName
+                     "colsByName": self.colsByName,
+                     "tile_hashes": self.tile_hashes
                      })
         if self.children is not None:
             for child in self.children:
                 child.save()
 
-    def load(self):
+    def load(self, infos = None):
+        if infos is None and self.tree.store is not None:
+            infos = self.tree.store.read_infos()
+        if infos is not None:
+            self.count, self.colsByName = infos[str(self.bounds)]
+            self.children = None
+            if str(self.bounds) + "0" in infos:
+                self.children = [QuadtreeNode(self.tree, b)
+                                 for b in self.bounds.get_children()]
+                for child in self.children:
+                    child.load(infos)
+            return
         with utils.msgpack_open(self.info_filename) as f:
             info = f.next()
             self.count = info['count']
             self.colsByName = info['colsByName']
+            self.tile_hashes = info.get('tile_hashes', {})
         self.children = []
         for child_bounds in self.bounds.get_children():
             child = QuadtreeNode(self.tree, child_bounds)
@@ -54,115 +108,628 @@ class QuadtreeNode(object):
         if not self.children:
             self.children = None
 
-    def generate_children(self):
-        """Generates the fours child files for this child if they don't already exist."""
+    def iter_source_rows(self):
+        if self.binary_source:
+            for row in utils.iter_records(self.source_filename):
+                yield row
+        else:
+            with utils.msgpack_open(self.source_filename) as f:
+                for row in f:
+                    yield row
 
-        if self.children is not None:
-            return
+    def generate_tree(self, max_depth = None, workers = 1, nodes = None):
+        """Generates child files down to self.max_depth, or until each
+        file is smaller than self.tree.max_count. Parent files are removed,
+        unless self.tree.remove = False.
 
-        print "Generating children for %s (%s rows)" % (self.bbox, self.count)
+        Rows are partitioned self.tree.partition_levels zoom levels at a
+        time: one pass over the source file counts rows per deep tile,
+        which decides the shape of the subtree, and a second pass writes
+        each row straight to its leaf. Only leaves that still hold more
+        than self.tree.max_count rows are read again. With workers > 1,
+        those leaves are partitioned by a pool of that many processes.
 
-        self.children = [QuadtreeNode(self.tree, b)
-                         for b in self.bounds.get_children()]
+        nodes continues an interrupted run: it lists the leaves left to
+        partition, as returned by replay_partitions().
 
-        with utils.msgpack_open(self.source_filename) as f:
-            with utils.msgpack_open(self.children[0].source_filename, "w") as self.children[0].file:
-                with utils.msgpack_open(self.children[1].source_filename, "w") as self.children[1].file:
-                    with utils.msgpack_open(self.children[2].source_filename, "w") as self.children[2].file:
-                        with utils.msgpack_open(self.children[3].source_filename, "w") as self.children[3].file:
-                            for row in f:
-                                for child in self.children:
-                                    if self.tree.latitude_col in row and self.tree.longitude_col in row and child.bbox.contains(row[self.tree.longitude_col], row[self.tree.latitude_col]):
-                                        child.file.write(row)
-                                        child.count += 1
-                                        break
-        for child in self.children:
-            del child.file
-
-        return self.children
-
-    def generate_tree(self, max_depth = None):
-        """Generates child files down to self.max_depth, or until each
-        file is smaller than self.tree.max_count. Parent files are removed,
-        unless self.tree.remove = False"""
+        With self.tree.tree_builder = "sort", the tree is instead built
+        in one go by sorting the rows by quadkey, see external_sort."""
 
         if max_depth is None:
             max_depth = self.tree.max_depth
-        else:
-            max_depth -= 1
-            if max_depth == 0:
-                return
-        self.generate_children()
+        max_zoom = None
+        if max_depth is not None:
+            max_zoom = self.bounds.zoom_level + max_depth
+        if nodes is None and self.tree.tree_builder == "sort":
+            external_sort.generate_tree(self, max_zoom)
+            return
+        if workers > 1:
+            parallel.generate_tree(self, max_zoom, workers, nodes)
+            return
+        if nodes is None:
+            nodes = self.partition(max_zoom, force_split = True)
+        while nodes:
+            nodes.extend(nodes.pop().partition(max_zoom))
+
+    def partition(self, max_zoom = None, force_split = False):
+        """Splits this node into a subtree of at most
+        self.tree.partition_levels levels in two passes over its source
+        file. Returns the leaves that still hold more than
+        self.tree.max_count rows and can be partitioned further.
+
+        If a leaf of the subtree gets at least self.tree.skew_fraction
+        of the rows, e.g. around a busy anchorage, the rows of that leaf
+        are counted again self.tree.partition_levels levels deeper
+        before any rows are written, and so on, instead of writing them
+        all to the leaf only to read them back in the next partition.
+        Nodes are never split beyond the max zoom level of tiles; rows
+        that are too dense to split further end up in leaves holding
+        more than self.tree.max_count rows, which are clustered in
+        chunks."""
+
+        zoom = self.bounds.zoom_level
+        limit = vectortile.TileBounds.maxzoom
+        if max_zoom is not None:
+            limit = min(limit, max_zoom)
+        depth = min(zoom + self.tree.partition_levels, limit)
+        if depth <= zoom:
+            return []
+
+        print "Partitioning %s (%s rows) down to zoom %s" % (self.bbox, self.count, depth)
+
+        with self.tree.metrics.stage("partition", gridcode=str(self.bounds), rows=self.count) as record:
+            with self.tree.metrics.time("histogram"):
+                histogram = {}
+                for row in self.iter_source_rows():
+                    key = self.row_quadkey(row, depth)
+                    if key is not None:
+                        histogram[key] = histogram.get(key, 0) + 1
+
+                leaves = {}
+                self.plan_children(histogram, depth, leaves, force_split)
+                steps = [(depth, histogram)]
+                passes = 2
+
+                while True:
+                    next_depth = min(depth + self.tree.partition_levels, limit)
+                    skewed = dict(
+                        (key, leaf) for (level, key), leaf in leaves.iteritems()
+                        if level == depth and leaf.count > self.tree.max_count
+                        and leaf.count >= self.tree.skew_fraction * self.count)
+                    if not skewed or next_depth <= depth:
+                        break
+                    print "Skewed: %s of %s rows in %s, counting them down to zoom %s" % (
+                        sum(leaf.count for leaf in skewed.itervalues()), self.count,
+                        ", ".join(str(leaf.bbox) for leaf in skewed.itervalues()), next_depth)
+                    shift = 2 * (next_depth - depth)
+                    histograms = dict((key, {}) for key in skewed)
+                    for row in self.iter_source_rows():
+                        key = self.row_quadkey(row, next_depth)
+                        if key is not None and key >> shift in histograms:
+                            leaf_histogram = histograms[key >> shift]
+                            leaf_histogram[key] = leaf_histogram.get(key, 0) + 1
+                    passes += 1
+                    histogram = {}
+                    for key, leaf in skewed.iteritems():
+                        del leaves[(depth, key)]
+                        leaf.plan_children(histograms[key], next_depth, leaves)
+                        histogram.update(histograms[key])
+                    depth = next_depth
+                    steps.append((depth, histogram))
+
+            for leaf in leaves.itervalues():
+                open(leaf.source_filename, "w").close()
+            # For each depth counted at, the leaf of every quadkey, or
+            # None where the rows were counted again deeper down
+            lookups = []
+            for level, histogram in steps:
+                leaf_by_key = {}
+                for key in histogram:
+                    leaf_by_key[key] = None
+                    for leaf_level in range(level, zoom, -1):
+                        leaf = leaves.get((leaf_level, key >> 2 * (level - leaf_level)))
+                        if leaf is not None:
+                            leaf_by_key[key] = leaf
+                            break
+                lookups.append((2 * (depth - level), leaf_by_key))
+
+            with self.tree.metrics.time("route"):
+                with utils.WriterCache(self.tree.max_open_files, self.tree.get_source_writer,
+                                       self.tree.route_buffer_size) as writers:
+                    for row in self.iter_source_rows():
+                        key = self.row_quadkey(row, depth)
+                        if key is not None:
+                            for shift, leaf_by_key in lookups:
+                                leaf = leaf_by_key[key >> shift]
+                                if leaf is not None:
+                                    break
+                            writers.write(leaf.source_filename, row)
+
+            record["leaves"] = len(leaves)
+            record["bytes_read"] = passes * metrics.file_size(self.source_filename)
+            record["bytes_written"] = sum(metrics.file_size(leaf.source_filename)
+                                          for leaf in leaves.itervalues())
+
+        oversized = [leaf for leaf in leaves.itervalues()
+                     if leaf.count > self.tree.max_count and leaf.bounds.zoom_level < limit]
+
+        if self.tree.journal is not None:
+            self.tree.journal.write({"type": "partition",
+                                     "gridcode": str(self.bounds),
+                                     "subtree": self.get_subtree(),
+                                     "leaves": [str(leaf.bounds) for leaf in oversized]})
+
         if self.tree.remove:
             os.unlink(self.source_filename)
-        for child in self.children:
-            if child.count > self.tree.max_count:
-                child.generate_tree(max_depth)
 
-    def generate_tiles(self):
+        return oversized
+
+    def replay_partitions(self, records):
+        """Rebuilds the subtrees partitioned by an interrupted run from
+        the partition records of its journal. Returns the leaves that
+        still need partitioning, or None if this node itself was not
+        partitioned."""
+        nodes = {str(self.bounds): self}
+        pending = set()
+        partitioned = False
+        for record in records:
+            if record["type"] != "partition" or record["gridcode"] not in nodes:
+                continue
+            node = nodes[record["gridcode"]]
+            node.set_subtree(record["subtree"])
+            for descendant in node.iter_nodes():
+                nodes[str(descendant.bounds)] = descendant
+            pending.discard(record["gridcode"])
+            pending.update(record["leaves"])
+            if node is self:
+                partitioned = True
+            if self.tree.remove and os.path.exists(node.source_filename):
+                os.unlink(node.source_filename)
+        if not partitioned:
+            return None
+        return [nodes[gridcode] for gridcode in sorted(pending)]
+
+    def row_quadkey(self, row, zoom_level):
+        if self.tree.latitude_col not in row or self.tree.longitude_col not in row:
+            return None
+        return utils.quadkey(row[self.tree.longitude_col], row[self.tree.latitude_col], zoom_level)
+
+    def plan_children(self, histogram, depth, leaves, force_split = False):
+        """Creates the children of this node, and recursively theirs,
+        from a histogram of row counts per quadkey at zoom level depth.
+        The leaves are collected in leaves, keyed by (zoom_level,
+        quadkey)."""
+
+        zoom = self.bounds.zoom_level
+        if zoom < depth and (force_split or self.count > self.tree.max_count):
+            shift = 2 * (depth - zoom - 1)
+            self.children = [QuadtreeNode(self.tree, b)
+                             for b in self.bounds.get_children()]
+            by_child = [{}, {}, {}, {}]
+            for key, count in histogram.iteritems():
+                by_child[(key >> shift) & 3][key] = count
+            for child, child_histogram in zip(self.children, by_child):
+                child.count = sum(child_histogram.itervalues())
+                child.plan_children(child_histogram, depth, leaves)
+        else:
+            leaves[(zoom, utils.gridcode2quadkey(str(self.bounds)))] = self
+
+    def get_subtree(self):
+        """Returns the counts of this node and its descendants as
+        nested lists, for passing subtrees between processes."""
+        children = None
+        if self.children is not None:
+            children = [child.get_subtree() for child in self.children]
+        return [self.count, children]
+
+    def set_subtree(self, subtree):
+        self.count, children = subtree
+        self.children = None
+        if children is not None:
+            self.children = [QuadtreeNode(self.tree, b)
+                             for b in self.bounds.get_children()]
+            for child, child_subtree in zip(self.children, children):
+                child.set_subtree(child_subtree)
+
+    def generate_tiles(self, workers = 1, gridcodes = None):
         """Generate tiles for all levels, assuming the tree has been
-        generated using generate_tree() first."""
+        generated using generate_tree() first. With workers > 1, tiles
+        are generated by a pool of that many processes.
+
+        If gridcodes is given, only the tiles of nodes with those
+        gridcodes are generated, reusing the cluster files of the other
+        nodes. It must contain the ancestors of every node in it."""
+        if workers > 1:
+            parallel.generate_tiles(self, workers, gridcodes)
+            return
+        if self.tree.pipelined:
+            pipeline.generate_tiles(self, gridcodes)
+            return
+        if gridcodes is not None and str(self.bounds) not in gridcodes:
+            return
         if self.children:
             for child in self.children:
-                child.generate_tiles()
-            print "Generating tile for %s using child tiles" % self.bbox
-            self.generate_tile_from_child_tiles()
-        else:
-            print "Generating tile for %s using source data" % self.bbox
-            self.generate_tile_from_source()
+                child.generate_tiles(gridcodes = gridcodes)
+        self.generate_tile()
+
+    def generate_tile(self, source = None):
+        """Generate the tile for this node only, from its source file
+        if it is a leaf, or else from the cluster files of its
+        children. source is as for generate_tile_from_source(). The
+        tile is journaled once its files are written.
 
-    def update_colsByName(self, row):
-        for key, value in row.iteritems():
-            if key not in self.colsByName:
-                self.colsByName[key] = {"min": value, "max": value}
+        self.colsByName starts over, as the ranges of a regenerated
+        tile, e.g. after append(), can be narrower than before."""
+        self.colsByName = {}
+        with self.tree.metrics.stage("tile", gridcode=str(self.bounds), rows=self.count):
+            if self.children:
+                print "Generating tile for %s using child tiles" % self.bbox
+                self.generate_tile_from_child_tiles()
             else:
-                if value < self.colsByName[key]['min']:
-                    self.colsByName[key]['min'] = value
-                if value > self.colsByName[key]['max']:
-                    self.colsByName[key]['max'] = value
-        return row
+                print "Generating tile for %s using source data" % self.bbox
+                self.generate_tile_from_source(source)
+        if self.tree.journal is not None:
+            record = {"type": "tile",
+                      "gridcode": str(self.bounds),
+                      "colsByName": self.colsByName,
+                      "tile_hashes": self.tile_hashes}
+            self.tree.after_writes(lambda: self.tree.journal.write(record))
+
+    def iter_nodes(self, gridcodes = None):
+        """Yields this node and all its descendants, parents before
+        children. If gridcodes is given, nodes not in it are skipped
+        together with their descendants."""
+        if gridcodes is not None and str(self.bounds) not in gridcodes:
+            return
+        yield self
+        if self.children:
+            for child in self.children:
+                for node in child.iter_nodes(gridcodes):
+                    yield node
+
+    def add_rows(self, source_filename, max_zoom = None):
+        """Appends the rows of source_filename to the source files of
+        the leaves below this node that contain them, and partitions
+        leaves that end up with more than self.tree.max_count rows.
+        Returns the gridcodes of all nodes that changed, which includes
+        their ancestors."""
+
+        zoom = max(node.bounds.zoom_level for node in self.iter_nodes())
+        leaves = set()
+        with utils.WriterCache(self.tree.max_open_files, self.tree.get_source_writer,
+                               self.tree.route_buffer_size) as writers:
+            with utils.msgpack_open(source_filename) as f:
+                for row in f:
+                    # Like ingest(), count rows without a position for the root
+                    self.count += 1
+                    key = self.row_quadkey(row, zoom)
+                    if key is None:
+                        continue
+                    node = self
+                    while node.children:
+                        node = node.children[(key >> 2 * (zoom - node.bounds.zoom_level - 1)) & 3]
+                        node.count += 1
+                    writers.write(node.source_filename, row)
+                    leaves.add(node)
+
+        gridcodes = set()
+        for leaf in leaves:
+            if leaf.count > self.tree.max_count:
+                print "Splitting %s (%s rows)" % (leaf.bbox, leaf.count)
+                nodes = leaf.partition(max_zoom)
+                while nodes:
+                    nodes.extend(nodes.pop().partition(max_zoom))
+            gridcodes.update(str(node.bounds) for node in leaf.iter_nodes())
+            gridcodes.update(str(ancestor) for ancestor in leaf.bounds.get_ancestors())
+        return gridcodes
+
+    def merge_colsByName(self, colsByName):
+        """Widens self.colsByName to the ranges in colsByName."""
+        for key, col in colsByName.iteritems():
+            own = self.colsByName.get(key)
+            if own is None:
+                self.colsByName[key] = {"min": col["min"], "max": col["max"]}
+                continue
+            if col["min"] < own["min"]:
+                own["min"] = col["min"]
+            if col["max"] > own["max"]:
+                own["max"] = col["max"]
+
+    @staticmethod
+    def get_colsByName(data):
+        """Returns the min and max of every column of data, rows as
+        returned by Quadtree.map_row(), which all have the same columns.
+        None and NaN values are left out, as are columns that have no
+        other values."""
+        colsByName = {}
+        if not data:
+            return colsByName
+        for name in data[0]:
+            values = [row[name] for row in data]
+            try:
+                array = numpy.array([numpy.nan if value is None else value for value in values],
+                                    dtype=numpy.float64)
+            except (TypeError, ValueError):
+                present = [value for value in values if value is not None]
+                if present:
+                    colsByName[name] = {"min": min(present), "max": max(present)}
+                continue
+            if numpy.isnan(array).all():
+                continue
+            # The values themselves, so that ints stay ints
+            colsByName[name] = {"min": values[numpy.nanargmin(array)],
+                                "max": values[numpy.nanargmax(array)]}
+        return colsByName
+
+    def read_clusters(self):
+        """Returns the clusters of the tile of this node as a
+        cluster.ClusterSet, taking them from
+        self.tree.written_clusters if they are kept there."""
+        if self.tree.written_clusters is not None:
+            clusters = self.tree.written_clusters.pop(str(self.bounds), None)
+            if clusters is not None:
+                return clusters
+        self.tree.metrics.add("bytes_read", metrics.file_size(self.cluster_filename))
+        if self.tree.store is not None:
+            return cluster_mod.ClusterSet.from_cluster_rows(
+                self.tree.store.read_clusters(str(self.bounds)))
+        if self.tree.record_format == "binary":
+            return cluster_mod.ClusterSet.from_cluster_records(
+                *utils.read_records(self.cluster_filename))
+        with utils.msgpack_open(self.cluster_filename) as f:
+            return cluster_mod.ClusterSet.from_cluster_rows(f)
+
+    def iter_time_buckets(self, clusters):
+        """Yields (bucket, indices) for every time bucket the clusters
+        fall in, where bucket is the start of the bucket and indices
+        selects its clusters. Clusters without a time come last, with a
+        bucket of None. If the tree is not time sliced, all clusters are
+        yielded as one bucket of None."""
+        if self.tree.time_buckets is None:
+            yield None, slice(None)
+            return
+        starts = utils.time_bucket_starts(clusters.get_means(self.tree.time_col), self.tree.time_buckets)
+        present = ~numpy.isnan(starts)
+        for start in numpy.unique(starts[present]):
+            yield int(start), numpy.flatnonzero(starts == start)
+        if not present.all():
+            yield None, numpy.flatnonzero(~present)
 
     def write_tile(self, clusters):
-        with utils.msgpack_open(self.cluster_filename, "w") as f:
-            for cluster in clusters:
-                f.write(cluster.get_cluster_row())
-
-        with open(self.tile_filename, "w") as f:
-            data = [self.update_colsByName(self.tree.map_row(cluster.get_row()))
-                    for cluster in clusters]
-            f.write(str(
-                    vectortile.Tile.fromdata(
+        """Writes the cluster file of this node, and its tile. If the
+        tree is time sliced, one tile is written per time bucket
+        instead."""
+        m = self.tree.metrics
+        m.add("clusters", len(clusters))
+
+        def written(result):
+            m.add("bytes_written", metrics.file_size(self.cluster_filename))
+
+        if self.tree.store is not None:
+            with m.time("write"):
+                self.tree.store.write_clusters(str(self.bounds), clusters.get_cluster_rows())
+            written(None)
+        elif self.tree.record_format == "binary":
+            self.tree.submit_write(utils.write_records,
+                                   (self.cluster_filename,) + tuple(clusters.get_cluster_records()),
+                                   written)
+        else:
+            self.tree.submit_write(utils.write_rows,
+                                   (self.cluster_filename, clusters.get_cluster_rows()),
+                                   written)
+        if self.tree.written_clusters is not None:
+            self.tree.written_clusters[str(self.bounds)] = clusters
+
+        if self.tree.time_buckets is None:
+            self.write_tile_data(clusters, str(self.bounds), self.tile_filename)
+            return
+        for bucket, indices in self.iter_time_buckets(clusters):
+            if bucket is not None:
+                self.write_tile_data(clusters.take(indices), self.get_time_tile_key(bucket),
+                                     self.get_time_tile_filename(bucket))
+
+    def write_tile_data(self, clusters, key, filename):
+        """Encodes clusters as a tile and writes it to filename, or to
+        the store under key.
+
+        Tiles are cached in self.tree.tile_cache by the content hash of
+        their clusters, so identical tiles, e.g. empty ones, are only
+        encoded once. A tile whose sha1 is that of the tile stored
+        before is not written again; for files, the sha1 is kept in
+        self.tile_hashes with the inode and modification time of the
+        file, so that a file replaced since is written anyway. With
+        self.tree.tile_links set, a tile identical to one written before
+        is linked to it instead of written."""
+        m = self.tree.metrics
+        cache = self.tree.tile_cache
+        content = (clusters.content_hash(), self.tree.columnMap_hash)
+
+        data = None
+        with m.time("map_row"):
+            colsByName = cache.get(("colsByName",) + content)
+            if colsByName is None:
+                data = [self.tree.map_row(row) for row in clusters.get_rows()]
+                colsByName = self.get_colsByName(data)
+                cache[("colsByName",) + content] = colsByName
+            self.merge_colsByName(colsByName)
+
+        tile_key = ("tile",) + content + (json.dumps(self.colsByName, sort_keys=True),)
+        tile = cache.get(tile_key)
+        if tile is None:
+            if data is None:
+                with m.time("map_row"):
+                    data = [self.tree.map_row(row) for row in clusters.get_rows()]
+            with m.time("encode"):
+                tile = str(vectortile.Tile.fromdata(
                         data,
-                        {"colsByName": self.colsByName})))
+                        {"colsByName": self.colsByName}))
+            cache[tile_key] = tile
+        else:
+            m.add("tiles_cached", 1)
 
-    def generate_tile_from_source(self):
-        with utils.msgpack_open(self.source_filename) as f:
-            rows = list(f)
+        digest = hashlib.sha1(tile).hexdigest()
+        if self.tree.store is not None:
+            with m.time("write"):
+                if self.tree.store.read_tile_hash(key) == digest:
+                    m.add("tiles_unchanged", 1)
+                    return
+                self.tree.store.write_tile(key, filename, tile, digest)
+            m.add("bytes_written", len(tile))
+            return
 
-        self.write_tile([cluster_mod.Cluster.from_row(row) for row in rows])
+        stored = self.tile_hashes.get(filename)
+        if stored is not None and stored[0] == digest and utils.file_stamp(filename) == stored[1:]:
+            m.add("tiles_unchanged", 1)
+            return
 
-    def generate_tile_from_child_tiles(self):
-        clusters = {}
-        for child in self.children:
-            with utils.msgpack_open(child.cluster_filename) as f:
-                for row in f:
-                    cluster = cluster_mod.Cluster.from_cluster_row(row)
-                    row = cluster.get_row()
-                    gridcode = str(vectortile.TileBounds.from_point(row[self.tree.longitude_col], row[self.tree.latitude_col], self.bounds.zoom_level + self.tree.clustering_levels))
-                    if gridcode not in clusters:
-                        clusters[gridcode] = cluster
-                    else:
-                        clusters[gridcode] += cluster
+        file_key = ("file", digest)
+        source = None
+        if self.tree.tile_links is not None:
+            source = cache.get(file_key)
 
+        def written(result):
+            result, stamp = result
+            self.tile_hashes[filename] = [digest] + stamp
+            if result == "linked":
+                m.add("tiles_linked", 1)
+            else:
+                cache[file_key] = filename
+                m.add("bytes_written", len(tile))
+
+        self.tree.submit_write(utils.write_file,
+                               (filename, tile, source, self.tree.tile_links == "symbolic"),
+                               written)
+
+    def get_grid_quadkeys(self, clusters, zoom_level = None):
+        """Returns the quadkeys of the grid cells used to cluster this
+        tile for the centroids of clusters, or of the cells at
+        zoom_level if given."""
+        if zoom_level is None:
+            zoom_level = self.bounds.zoom_level + self.tree.clustering_levels
+        return utils.quadkeys(clusters.get_means(self.tree.longitude_col),
+                              clusters.get_means(self.tree.latitude_col),
+                              zoom_level)
+
+    def aggregate_duplicates(self, clusters):
+        """Merges the clusters of source rows at the same position, that
+        is, in the same grid cell at zoom level self.tree.duplicate_zoom,
+        and in the same time bucket. Returns clusters unchanged if
+        self.tree.duplicate_zoom is None."""
+        if self.tree.duplicate_zoom is None or not len(clusters):
+            return clusters
+        quadkeys = self.get_grid_quadkeys(clusters, self.tree.duplicate_zoom)
+        buckets = []
+        for bucket, indices in self.iter_time_buckets(clusters):
+            cells, groups = numpy.unique(quadkeys[indices], return_inverse=True)
+            buckets.append((bucket, clusters.take(indices).group(groups)))
+        return self.concatenate_time_buckets(buckets)
+
+    def merge_clusters(self, clusters, quadkeys):
+        """Merges clusters with the same quadkey, then merges them into
+        ever coarser grid cells until there are no more than
+        self.tree.max_count. Returns the merged clusters, their
+        quadkeys and the number of levels they were coarsened by."""
+        quadkeys, groups = numpy.unique(quadkeys, return_inverse=True)
+        clusters = clusters.group(groups)
+        levels = 0
         # Merge clusters until we have few enough for a tile
         while len(clusters) > self.tree.max_count:
-            newclusters = {}
-            for gridcode, cluster in clusters.iteritems():
-                gridcode = gridcode[:-1]
-                if gridcode not in newclusters:
-                    newclusters[gridcode] = cluster
-                else:
-                    newclusters[gridcode] += cluster
-            clusters = newclusters
-
-        self.write_tile(clusters.values())
+            quadkeys, groups = numpy.unique(quadkeys >> 2, return_inverse=True)
+            clusters = clusters.group(groups)
+            levels += 1
+        return clusters, quadkeys, levels
+
+    def iter_source_chunks(self):
+        """Yields the source rows as one cluster.ClusterSet per
+        self.tree.chunk_size rows."""
+        if self.binary_source:
+            columns, records = utils.read_records(self.source_filename)
+            for start in xrange(0, len(records), self.tree.chunk_size):
+                yield cluster_mod.ClusterSet.from_source_records(
+                    columns, records[start:start + self.tree.chunk_size])
+        else:
+            with utils.msgpack_open(self.source_filename) as f:
+                while True:
+                    rows = list(itertools.islice(f, self.tree.chunk_size))
+                    if not rows:
+                        break
+                    yield cluster_mod.ClusterSet.from_rows(rows)
+
+    def read_source_clusters(self):
+        """Returns one cluster per row of the source file."""
+        if self.binary_source:
+            return cluster_mod.ClusterSet.from_source_records(
+                *utils.read_records(self.source_filename))
+        with utils.msgpack_open(self.source_filename) as f:
+            return cluster_mod.ClusterSet.from_rows(f)
+
+    def generate_tile_from_source(self, source = None):
+        """source, if given, is an object whose get() returns
+        read_source_clusters(), e.g. as read ahead by a pipeline."""
+        self.tree.metrics.add("bytes_read", metrics.file_size(self.source_filename))
+        if self.count > self.tree.max_count:
+            self.generate_tile_from_source_chunks()
+            return
+        with self.tree.metrics.time("read"):
+            if source is not None:
+                clusters = source.get()
+            else:
+                clusters = self.read_source_clusters()
+        with self.tree.metrics.time("cluster"):
+            clusters = self.aggregate_duplicates(clusters)
+        self.write_tile(clusters)
+
+    def generate_tile_from_source_chunks(self):
+        """Generates the tile of a leaf holding more than
+        self.tree.max_count rows, e.g. because max_depth stopped the
+        split. The source file is read self.tree.chunk_size rows at a
+        time and each chunk is clustered onto the grid used for parent
+        tiles, so memory use is bounded by the chunk size rather than by
+        the number of rows."""
+        # (clusters, quadkeys, levels) per time bucket
+        buckets = {}
+        peak = 0
+        chunks = self.iter_source_chunks()
+        while True:
+            with self.tree.metrics.time("read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with self.tree.metrics.time("cluster"):
+                chunk = self.aggregate_duplicates(chunk)
+                chunk_quadkeys = self.get_grid_quadkeys(chunk)
+                for bucket, indices in self.iter_time_buckets(chunk):
+                    clusters, quadkeys, levels = buckets.get(
+                        bucket, (cluster_mod.ClusterSet(), numpy.zeros(0, dtype=numpy.int64), 0))
+                    clusters = cluster_mod.ClusterSet.concatenate([clusters, chunk.take(indices)])
+                    quadkeys = numpy.concatenate([quadkeys, chunk_quadkeys[indices] >> 2 * levels])
+                    peak = max(peak, len(clusters))
+                    clusters, quadkeys, more_levels = self.merge_clusters(clusters, quadkeys)
+                    buckets[bucket] = (clusters, quadkeys, levels + more_levels)
+
+        clusters = self.concatenate_time_buckets(
+            [(bucket, clusters) for bucket, (clusters, quadkeys, levels) in buckets.iteritems()])
+        print "Clustered %s rows for %s holding at most %s clusters (max RSS %s kB)" % (
+            self.count, self.bbox, peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        self.write_tile(clusters)
+
+    def concatenate_time_buckets(self, buckets):
+        """Concatenates a list of (bucket, clusters) ordered by bucket,
+        with clusters without a time last."""
+        if len(buckets) == 1:
+            return buckets[0][1]
+        buckets.sort(key=lambda (bucket, clusters): (bucket is None, bucket))
+        return cluster_mod.ClusterSet.concatenate([clusters for bucket, clusters in buckets])
+
+    def generate_tile_from_child_tiles(self):
+        """Merges the clusters of the child tiles, separately for every
+        time bucket if the tree is time sliced."""
+        with self.tree.metrics.time("read"):
+            clusters = cluster_mod.ClusterSet.concatenate(
+                [child.read_clusters() for child in self.children])
+        with self.tree.metrics.time("cluster"):
+            quadkeys = self.get_grid_quadkeys(clusters)
+            clusters = self.concatenate_time_buckets(
+                [(bucket, self.merge_clusters(clusters.take(indices), quadkeys[indices])[0])
+                 for bucket, indices in self.iter_time_buckets(clusters)])
+        self.write_tile(clusters)
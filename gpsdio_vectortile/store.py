@@ -0,0 +1,72 @@
+"""
+Single file storage for the node info, cluster rows and tiles of a tree
+"""
+
+import msgpack
+import sqlite3
+
+
+class SqliteStore(object):
+    """Keeps the info, cluster rows and tile of every node in one SQLite
+    database keyed by gridcode, instead of three files per node in the
+    current directory. Source files are still plain files, as they are
+    streamed and appended to while the tree is partitioned."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=600)
+        with self.db:
+            self.db.execute("create table if not exists info (gridcode text primary key, count integer, colsByName blob)")
+            self.db.execute("create table if not exists clusters (gridcode text primary key, data blob)")
+            self.db.execute("create table if not exists tiles (gridcode text primary key, bbox text, data blob, hash text)")
+            columns = [row[1] for row in self.db.execute("pragma table_info(tiles)")]
+            if "hash" not in columns:
+                self.db.execute("alter table tiles add column hash text")
+
+    def write_infos(self, infos):
+        """infos is a list of (gridcode, count, colsByName)."""
+        with self.db:
+            self.db.execute("delete from info")
+            self.db.executemany(
+                "insert into info values (?, ?, ?)",
+                [(gridcode, count, buffer(msgpack.packb(colsByName)))
+                 for gridcode, count, colsByName in infos])
+
+    def read_infos(self):
+        """Returns a dictionary from gridcode to (count, colsByName) for
+        all nodes."""
+        return dict((str(gridcode), (count, msgpack.unpackb(str(colsByName))))
+                    for gridcode, count, colsByName
+                    in self.db.execute("select gridcode, count, colsByName from info"))
+
+    def write_clusters(self, gridcode, rows):
+        packer = msgpack.Packer()
+        with self.db:
+            self.db.execute("insert or replace into clusters values (?, ?)",
+                            (gridcode, buffer("".join(packer.pack(row) for row in rows))))
+
+    def read_clusters(self, gridcode):
+        unpacker = msgpack.Unpacker()
+        for data, in self.db.execute("select data from clusters where gridcode = ?", (gridcode,)):
+            unpacker.feed(str(data))
+        return list(unpacker)
+
+    def write_tile(self, gridcode, bbox, data, digest = None):
+        """For time sliced tiles, gridcode and bbox are prefixed with
+        the time extent, as in "start,end;gridcode". digest, the hex
+        sha1 of data, is kept for read_tile_hash()."""
+        with self.db:
+            self.db.execute("insert or replace into tiles (gridcode, bbox, data, hash) values (?, ?, ?, ?)",
+                            (gridcode, bbox, buffer(data), digest))
+
+    def read_tile(self, gridcode):
+        for data, in self.db.execute("select data from tiles where gridcode = ?", (gridcode,)):
+            return str(data)
+        return None
+
+    def read_tile_hash(self, gridcode):
+        """Returns the hex sha1 of the tile stored under gridcode, or
+        None if there is none."""
+        for digest, in self.db.execute("select hash from tiles where gridcode = ?", (gridcode,)):
+            return digest and str(digest)
+        return None
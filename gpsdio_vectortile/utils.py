@@ -1,7 +1,13 @@
 import msgpack
 import contextlib
+import collections
+import mmap
+import numpy
+import os
 import struct
 
+NaN = float("nan")
+
 class Writer(object):
     def __init__(self, file):
         self.file = file
@@ -10,17 +16,383 @@ class Writer(object):
     def write(self, obj):
         self.file.write(self.packer.pack(obj))
 
+    def write_many(self, objs):
+        self.file.write("".join(self.packer.pack(obj) for obj in objs))
+
+@contextlib.contextmanager
+def atomic_open(name):
+    """Opens name for writing through a temporary file that is renamed
+    to name once the block completes, so that name never holds a
+    partially written file."""
+    tmp_name = name + ".tmp"
+    try:
+        with open(tmp_name, "w") as f:
+            yield f
+        os.rename(tmp_name, name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+
 @contextlib.contextmanager
 def msgpack_open(name, mode='r'):
     if mode == 'r':
         with open(name) as f:
             yield msgpack.Unpacker(f)
+    elif mode == 'w':
+        with atomic_open(name) as f:
+            yield Writer(f)
     else:
         with open(name, mode) as f:
             yield Writer(f)
 
+def append_write(name, data, sync = False):
+    """Appends data to the file name, creating it if needed, with a
+    single write to the end of the file, so that several processes can
+    append to the same file without interleaving their data. With sync
+    = True, the data is synced to disk before returning."""
+    fd = os.open(name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, data)
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Journal(object):
+    """An append only file of msgpack records, written with
+    append_write() and synced to disk, so several processes can share a
+    journal, and a crash loses at most the record being written."""
+
+    def __init__(self, name):
+        self.name = name
+        self.packer = msgpack.Packer()
+
+    def write(self, obj):
+        append_write(self.name, self.packer.pack(obj), sync=True)
+
+    def read(self):
+        """Returns all complete records, dropping a partially written
+        last record from the file."""
+        if not os.path.exists(self.name):
+            return []
+        records = []
+        end = 0
+        with msgpack_open(self.name) as f:
+            for record in f:
+                records.append(record)
+                end = f.tell()
+        if end != os.path.getsize(self.name):
+            with open(self.name, "r+") as f:
+                f.truncate(end)
+        return records
+
+    def clear(self):
+        if os.path.exists(self.name):
+            os.unlink(self.name)
+
+def read_record_header(f):
+    """Reads the column names at the start of a record file and returns
+    them together with the offset of the first record."""
+    length, = struct.unpack("<Q", f.read(8))
+    columns = msgpack.unpackb(f.read(length))
+    return columns, 8 + length + (-length % 8)
+
+def write_record_header(f, columns):
+    header = msgpack.packb(list(columns))
+    f.write(struct.pack("<Q", len(header)) + header + "\0" * (-len(header) % 8))
+
+class RecordWriter(object):
+    """Writes rows as fixed width records of little endian float64
+    values, one per column, with NaN for missing values. The column
+    names are stored in a header at the start of the file; when
+    appending to a file that already has one, its columns are used and
+    values for other columns are dropped."""
+
+    def __init__(self, file, columns):
+        self.file = file
+        if os.fstat(file.fileno()).st_size:
+            with open(file.name, "rb") as f:
+                columns, offset = read_record_header(f)
+        else:
+            write_record_header(file, columns)
+        self.columns = columns
+        self.struct = struct.Struct("<%sd" % len(columns))
+
+    def write(self, obj):
+        self.file.write(self.struct.pack(*[float(obj.get(col, NaN)) for col in self.columns]))
+
+    def write_many(self, objs):
+        self.file.write("".join(self.struct.pack(*[float(obj.get(col, NaN)) for col in self.columns])
+                                for obj in objs))
+
+def write_records(name, columns, records):
+    """Atomically writes a two dimensional array with one column per
+    entry in columns as a record file."""
+    with atomic_open(name) as f:
+        write_record_header(f, columns)
+        f.write(numpy.ascontiguousarray(records, dtype="<f8").tostring())
+
+def read_records(name):
+    """Returns the columns and records of a record file. The records
+    are a read only array memory mapped from the file, with one row
+    per record."""
+    with open(name, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return [], numpy.zeros((0, 0))
+        columns, offset = read_record_header(f)
+        if os.fstat(f.fileno()).st_size <= offset:
+            return columns, numpy.zeros((0, len(columns)))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return columns, numpy.frombuffer(data, dtype="<f8", offset=offset).reshape(-1, len(columns))
+
+def iter_records(name, chunk_size = 10000):
+    """Yields the records of a record file as rows, leaving out
+    missing (NaN) values. Only chunk_size records at a time are
+    converted to Python values."""
+    columns, records = read_records(name)
+    for start in xrange(0, len(records), chunk_size):
+        for record in records[start:start + chunk_size].tolist():
+            yield dict((col, value) for col, value in zip(columns, record) if value == value)
+
+class WriterCache(object):
+    """Appends rows to many files while keeping at most max_open of
+    them open, closing the least recently used one when another file
+    is needed. Rows are buffered per file and written in one block per
+    file once buffer_size rows are buffered in total, and on close(),
+    so a file is opened at most once per flush rather than once per
+    row. Files must exist (they are opened for append). Writers are
+    made by calling make_writer with the open file, once per file: the
+    writer of a file that was closed is given the reopened file, so
+    e.g. a RecordWriter reads the header of a file only once."""
+
+    def __init__(self, max_open, make_writer = Writer, buffer_size = 1):
+        self.max_open = max_open
+        self.make_writer = make_writer
+        self.buffer_size = buffer_size
+        self.writers = collections.OrderedDict()
+        self.closed = {}
+        self.buffers = {}
+        self.buffered = 0
+
+    def write(self, name, obj):
+        buf = self.buffers.get(name)
+        if buf is None:
+            buf = self.buffers[name] = []
+        buf.append(obj)
+        self.buffered += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the rows buffered for every file."""
+        for name, objs in self.buffers.iteritems():
+            self.get_writer(name).write_many(objs)
+        self.buffers.clear()
+        self.buffered = 0
+
+    def get_writer(self, name):
+        writer = self.writers.pop(name, None)
+        if writer is None:
+            if len(self.writers) >= self.max_open:
+                old_name, old = self.writers.popitem(last=False)
+                old.file.close()
+                self.closed[old_name] = old
+            writer = self.closed.pop(name, None)
+            if writer is None:
+                writer = self.make_writer(open(name, "a"))
+            else:
+                writer.file = open(name, "a")
+        self.writers[name] = writer
+        return writer
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for writer in self.writers.itervalues():
+                writer.file.close()
+            self.writers.clear()
+            self.closed.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class LRUCache(object):
+    """A dictionary holding at most max_size items, dropping the least
+    recently used one when full."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+
+    def get(self, key, default = None):
+        if key not in self.items:
+            return default
+        value = self.items[key] = self.items.pop(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        if len(self.items) >= self.max_size:
+            self.items.popitem(last=False)
+        self.items[key] = value
+
+    def __len__(self):
+        return len(self.items)
+
+def link_file(source, name, symbolic = False):
+    """Makes name a hard link to, or with symbolic = True a symbolic
+    link to, source, which must be in the same directory. Like
+    atomic_open(), replaces an existing name in one rename."""
+    tmp_name = name + ".tmp"
+    if os.path.lexists(tmp_name):
+        os.unlink(tmp_name)
+    try:
+        if symbolic:
+            os.symlink(os.path.basename(source), tmp_name)
+        else:
+            os.link(source, tmp_name)
+        os.rename(tmp_name, name)
+    finally:
+        if os.path.lexists(tmp_name):
+            os.unlink(tmp_name)
+
+def same_content(name, data):
+    """Whether the file name exists and holds exactly data."""
+    if not os.path.exists(name) or os.path.getsize(name) != len(data):
+        return False
+    with open(name) as f:
+        return f.read() == data
+
+def write_rows(name, rows):
+    """Atomically writes rows to name as msgpack."""
+    with msgpack_open(name, "w") as f:
+        f.write_many(rows)
+
+def file_stamp(name):
+    """Returns the inode number and modification time of the file name,
+    which change whenever it is replaced, or None if it does not
+    exist."""
+    try:
+        stat = os.stat(name)
+    except OSError:
+        return None
+    return [stat.st_ino, stat.st_mtime]
+
+def write_file(name, data, link_source = None, symbolic = False):
+    """Writes data to name, or if link_source is given, links name to
+    it (see link_file), as it holds data. Returns "written" or "linked"
+    and the file_stamp() of name."""
+    if link_source is not None:
+        link_file(link_source, name, symbolic)
+        return "linked", file_stamp(name)
+    with atomic_open(name) as f:
+        f.write(data)
+    return "written", file_stamp(name)
+
 def float2bits(f):
     return struct.unpack('>l', struct.pack('>f', f))[0]
 
 def bits2float(b):
     return struct.unpack('>f', struct.pack('>l', b))[0]
+
+_spread = [sum(((i >> bit) & 1) << (2 * bit) for bit in range(8))
+           for i in range(256)]
+
+def quadkey(lon, lat, zoom_level):
+    """Returns the tile containing a point at zoom_level as an
+    integer. Written in base 4 and padded to zoom_level digits, this
+    is the vectortile.TileBounds gridcode, so the key of the parent
+    tile is quadkey >> 2. Points outside the world bbox give None."""
+    if not (-180.0 <= lon < 180.0 and -90.0 <= lat < 90.0):
+        return None
+    size = 1 << zoom_level
+    x = int(size * (lon + 180.0) / 360.0)
+    y = int(size * (lat + 90.0) / 180.0)
+    key = 0
+    shift = 0
+    while x or y:
+        key |= (_spread[x & 0xff] | (_spread[y & 0xff] << 1)) << shift
+        x >>= 8
+        y >>= 8
+        shift += 16
+    return key
+
+_spread_array = numpy.array(_spread, dtype=numpy.int64)
+
+def quadkeys(lons, lats, zoom_level):
+    """Vectorized quadkey() for arrays of points inside the world
+    bbox, for zoom levels up to 31."""
+    size = 1 << zoom_level
+    lons = numpy.where(lons == 180.0, -180.0, lons)
+    x = numpy.clip(numpy.floor(size * (lons + 180.0) / 360.0), 0, size - 1).astype(numpy.int64)
+    y = numpy.clip(numpy.floor(size * (lats + 90.0) / 180.0), 0, size - 1).astype(numpy.int64)
+    keys = numpy.zeros(x.shape, dtype=numpy.int64)
+    for shift in range(0, 2 * zoom_level, 16):
+        keys |= (_spread_array[x & 0xff] | (_spread_array[y & 0xff] << 1)) << shift
+        x >>= 8
+        y >>= 8
+    return keys
+
+def gridcode2quadkey(gridcode):
+    if not gridcode:
+        return 0
+    return int(gridcode, 4)
+
+def quadkey2gridcode(key, zoom_level):
+    digits = []
+    for i in range(zoom_level):
+        digits.append("0123"[key & 3])
+        key >>= 2
+    return "".join(reversed(digits))
+
+def weighted_quantiles(values, weights, probabilities):
+    """Returns the values below which the given fractions of the total
+    weight fall, leaving out NaN values, or None if there are none."""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    present = ~numpy.isnan(values)
+    values = values[present]
+    weights = weights[present]
+    if not len(values):
+        return None
+    order = numpy.argsort(values, kind="mergesort")
+    cumulative = numpy.cumsum(weights[order])
+    positions = numpy.searchsorted(cumulative, numpy.asarray(probabilities) * cumulative[-1])
+    return values[order][numpy.minimum(positions, len(values) - 1)].tolist()
+
+time_bucket_units = {"year": "Y", "month": "M", "week": "W", "day": "D"}
+
+_day = 24 * 60 * 60 * 1000
+_week = 7 * _day
+# 1970-01-01 was a Thursday; weeks start on Mondays
+_week_offset = 3 * _day
+
+def time_bucket_starts(millis, unit):
+    """Returns the start, in milliseconds since the epoch, of the year,
+    month, week (starting on Monday) or day each of millis falls in,
+    and NaN for NaN."""
+    millis = numpy.asarray(millis, dtype=numpy.float64)
+    present = ~numpy.isnan(millis)
+    starts = numpy.empty(millis.shape)
+    starts.fill(NaN)
+    values = numpy.floor(millis[present]).astype(numpy.int64)
+    if unit == "week":
+        values = (values + _week_offset) // _week * _week - _week_offset
+    else:
+        values = values.astype("datetime64[ms]").astype(
+            "datetime64[%s]" % time_bucket_units[unit]).astype("datetime64[ms]").astype(numpy.int64)
+    starts[present] = values
+    return starts
+
+def time_bucket_end(start, unit):
+    """Returns the end of the time bucket starting at start, which is
+    the start of the next one."""
+    if unit == "week":
+        return start + _week
+    code = time_bucket_units[unit]
+    start = numpy.datetime64(int(start), "ms").astype("datetime64[%s]" % code)
+    return int((start + 1).astype("datetime64[ms]").astype(numpy.int64))
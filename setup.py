@@ -59,14 +59,19 @@ setup_args = dict(
         vectortile_generate_tree=gpsdio_vectortile.core:gpsdio_vectortile_generate_tree
         vectortile_generate_tiles=gpsdio_vectortile.core:gpsdio_vectortile_generate_tiles
         vectortile_generate_headers=gpsdio_vectortile.core:gpsdio_vectortile_generate_headers
+        vectortile_append=gpsdio_vectortile.core:gpsdio_vectortile_append
+        vectortile_metrics_report=gpsdio_vectortile.core:gpsdio_vectortile_metrics_report
+        vectortile_export=gpsdio_vectortile.core:gpsdio_vectortile_export
     ''',
     extras_require={
+        'brotli': ['brotli'],
         'test': ['pytest', 'pytest-cov']
     },
     include_package_data=True,
     install_requires=[
         'click>=3.0',
         'gpsdio>=0.0.2',
+        'numpy',
         'vectortile>=1.3.3'
     ],
     keywords='AIS GIS remote sensing sort',
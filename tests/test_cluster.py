@@ -0,0 +1,65 @@
+"""
+Unittests for gpsdio_vectortile.cluster
+"""
+
+
+import numpy
+
+from gpsdio_vectortile.cluster import ClusterSet
+
+
+def test_group_matches_numpy_std_for_timestamps():
+    numpy.random.seed(0)
+    # Milliseconds since the epoch around 2014, a few minutes apart
+    timestamps = 1.4e12 + numpy.random.normal(0.0, 1e5, 4 ** 5)
+    clusters = ClusterSet.from_rows({"timestamp": value} for value in timestamps.tolist())
+    groups = numpy.arange(len(timestamps))
+    for level in range(1, 6):
+        # Merge the clusters of every 4 consecutive groups, as coarsening
+        # a grid by one zoom level does
+        clusters = clusters.group(numpy.arange(len(clusters)) // 4)
+        groups //= 4
+        assert len(clusters) == 4 ** (5 - level)
+        rows = clusters.get_rows()
+        for group, row in enumerate(rows):
+            values = timestamps[groups == group]
+            assert clusters.counts[group, 0] == len(values)
+            assert abs(row["timestamp"] - values.mean()) <= 1e-3
+            assert numpy.allclose(row["timestamp_stddev"], values.std(), rtol=1e-9)
+
+
+def test_group_keeps_missing_columns_apart():
+    clusters = ClusterSet.from_rows([{"a": 1.0}, {"b": 2.0}, {"a": 3.0, "b": 4.0}])
+    rows = clusters.group(numpy.array([0, 0, 0])).get_rows()
+    assert rows == [{"a": 2.0, "a_stddev": 1.0, "b": 3.0, "b_stddev": 1.0}]
+
+
+def test_cluster_rows_roundtrip():
+    clusters = ClusterSet.from_rows([{"a": 1.0, "b": 5.0}, {"a": 3.0}, {"a": 8.0, "b": 7.0}])
+    clusters = clusters.group(numpy.array([0, 0, 1]))
+    read = ClusterSet.from_cluster_rows(clusters.get_cluster_rows())
+    assert read.get_rows() == clusters.get_rows()
+    columns, records = clusters.get_cluster_records()
+    read = ClusterSet.from_cluster_records(columns, records)
+    assert read.get_rows() == clusters.get_rows()
+
+
+def test_legacy_cluster_rows():
+    # Rows written by earlier versions, for the values 1, 2, 3 and 4, 6
+    rows = [{"counts__a": 3.0, "sums__a": 6.0, "sqr_sums__a": 14.0},
+            {"counts__a": 2.0, "sums__a": 10.0, "sqr_sums__a": 52.0,
+             "counts__b": 1.0, "sums__b": 7.0, "sqr_sums__b": 49.0}]
+    expected = [{"a": 2.0, "a_stddev": numpy.sqrt(2.0 / 3.0)},
+                {"a": 5.0, "a_stddev": 1.0, "b": 7.0, "b_stddev": 0.0}]
+    clusters = ClusterSet.from_cluster_rows(rows)
+    assert clusters.get_rows() == expected
+
+    columns = ["counts__a", "sums__a", "sqr_sums__a", "counts__b", "sums__b", "sqr_sums__b"]
+    records = numpy.array([[row.get(col, 0.0) for col in columns] for row in rows])
+    clusters = ClusterSet.from_cluster_records(columns, records)
+    assert clusters.get_rows() == expected
+
+    merged = clusters.group(numpy.array([0, 0])).get_rows()[0]
+    values = numpy.array([1.0, 2.0, 3.0, 4.0, 6.0])
+    assert numpy.allclose(merged["a"], values.mean())
+    assert numpy.allclose(merged["a_stddev"], values.std())
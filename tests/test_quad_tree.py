@@ -0,0 +1,146 @@
+"""
+Unittests for gpsdio_vectortile.quad_tree
+"""
+
+
+import datetime
+import json
+import random
+
+import gpsdio
+import vectortile
+
+from gpsdio_vectortile import quad_tree
+from gpsdio_vectortile import utils
+
+
+def skewed_rows(seed=0):
+    """Returns a few rows spread over the world, many more in a box of
+    5e-4 degrees within a single zoom level 16 tile, and rows at a
+    single point in that box, which are too dense to split beyond the
+    max zoom level."""
+    random.seed(seed)
+    points = [(random.uniform(-179.0, 179.0), random.uniform(-80.0, 80.0)) for i in range(60)]
+    points += [(10.6975 + random.random() * 5e-4, 59.901 + random.random() * 5e-4) for i in range(1500)]
+    points += [(10.69775, 59.90125)] * 400
+    return [{"mmsi": 200000000 + i % 7, "type": 1, "lon": lon, "lat": lat,
+             "timestamp": datetime.datetime(2015, 1, 1) + datetime.timedelta(seconds=i),
+             "course": random.uniform(0.0, 360.0), "speed": random.uniform(0.0, 20.0),
+             "track": i % 7}
+            for i, (lon, lat) in enumerate(points)]
+
+
+def write_rows(name, rows):
+    with gpsdio.open(name, "w") as f:
+        for row in rows:
+            f.write(row)
+    return name
+
+
+def split_level_by_level(points, max_count):
+    """Returns the count of every node of a tree that splits nodes one
+    zoom level at a time while they hold more than max_count points,
+    keyed by gridcode."""
+    maxzoom = vectortile.TileBounds.maxzoom
+    counts = {}
+    nodes = [("", [utils.quadkey(lon, lat, maxzoom) for lon, lat in points])]
+    while nodes:
+        gridcode, keys = nodes.pop()
+        counts[gridcode] = len(keys)
+        zoom = len(gridcode)
+        if (not gridcode or len(keys) > max_count) and zoom < maxzoom:
+            shift = 2 * (maxzoom - zoom - 1)
+            for child in range(4):
+                nodes.append((gridcode + "0123"[child],
+                              [key for key in keys if (key >> shift) & 3 == child]))
+    return counts
+
+
+def build_tree(tmpdir, points_filename, **kw):
+    with tmpdir.as_cwd():
+        tree = quad_tree.Quadtree.generate(points_filename, max_count=50, **kw)
+        leaves = {}
+        for node in tree.root.iter_nodes():
+            if not node.children:
+                leaves[str(node.bounds)] = sorted(
+                    (row["lon"], row["lat"], row["timestamp"]) for row in node.iter_source_rows())
+    counts = dict((str(node.bounds), node.count) for node in tree.root.iter_nodes())
+    return counts, leaves
+
+
+def test_partition_matches_level_by_level_split(tmpdir):
+    rows = skewed_rows()
+    points_filename = write_rows(str(tmpdir.join("points.msg")), rows)
+    points = [(row["lon"], row["lat"]) for row in rows]
+    expected = split_level_by_level(points, 50)
+    maxzoom = vectortile.TileBounds.maxzoom
+    assert any(count > 50 and len(gridcode) == maxzoom for gridcode, count in expected.iteritems())
+
+    results = []
+    for partition_levels in (1, 8):
+        workdir = tmpdir.join("levels-%s" % partition_levels)
+        workdir.mkdir()
+        metrics_filename = str(workdir.join("metrics.json"))
+        counts, leaves = build_tree(workdir, points_filename, partition_levels=partition_levels,
+                                    metrics_filename=metrics_filename)
+        assert counts == expected
+        for gridcode, rows in leaves.iteritems():
+            assert len(rows) == counts[gridcode]
+            for lon, lat, timestamp in rows:
+                key = utils.quadkey(lon, lat, len(gridcode))
+                assert utils.quadkey2gridcode(key, len(gridcode)) == gridcode
+        results.append(leaves)
+
+        with open(metrics_filename) as f:
+            stages = [json.loads(line) for line in f]
+        partitions = [stage for stage in stages if stage["stage"] == "partition"]
+        if partition_levels == 8:
+            # The dense rows are counted again deeper down within the
+            # partition of the root, instead of being partitioned again
+            assert len(partitions) == 1
+    assert results[0] == results[1]
+
+
+def test_sort_builder_matches_partition_builder(tmpdir):
+    points_filename = write_rows(str(tmpdir.join("points.msg")), skewed_rows())
+    results = []
+    for tree_builder in ("partition", "sort"):
+        workdir = tmpdir.join(tree_builder)
+        workdir.mkdir()
+        # Small runs, merged a few at a time, so that the sort builder
+        # merges in several passes
+        results.append(build_tree(workdir, points_filename, tree_builder=tree_builder,
+                                  sort_run_size=300, max_open_files=3))
+    (partition_counts, partition_leaves), (sort_counts, sort_leaves) = results
+    assert sorted(sort_counts) == sorted(partition_counts)
+    assert sort_counts == partition_counts
+    assert sort_leaves == partition_leaves
+
+
+def test_append_matches_rebuild(tmpdir):
+    rows = skewed_rows()
+    random.seed(1)
+    random.shuffle(rows)
+    first_filename = write_rows(str(tmpdir.join("first.msg")), rows[:1000])
+    second_filename = write_rows(str(tmpdir.join("second.msg")), rows[1000:])
+    all_filename = write_rows(str(tmpdir.join("all.msg")), rows)
+
+    trees = []
+    for name, filenames in (("append", [first_filename, second_filename]),
+                            ("rebuild", [all_filename])):
+        workdir = tmpdir.join(name)
+        workdir.mkdir()
+        with workdir.as_cwd():
+            tree = quad_tree.Quadtree.generate(filenames[0], max_count=50)
+            tree.generate_tiles()
+            for filename in filenames[1:]:
+                tree.append(filename)
+                tree.save()
+            trees.append(quad_tree.Quadtree.load())
+
+    appended, rebuilt = [dict((str(node.bounds), (node.count, node.colsByName))
+                              for node in tree.root.iter_nodes())
+                         for tree in trees]
+    assert sorted(appended) == sorted(rebuilt)
+    for gridcode, (count, colsByName) in rebuilt.iteritems():
+        assert appended[gridcode] == (count, colsByName), gridcode
@@ -0,0 +1,64 @@
+"""
+Unittests for gpsdio_vectortile.utils
+"""
+
+
+import numpy
+import vectortile
+
+from gpsdio_vectortile import utils
+
+
+def corner_points(zoom_level):
+    """Yields the lower left corner of every tile at zoom_level, points
+    a millionth of a tile below and left of it and above and right of
+    it, and points on the world's edges. TileBounds.from_point() may
+    round coordinates to 32 bits, so points closer to an edge than
+    that have no single right tile."""
+    size = 1 << zoom_level
+    lon_offset = 360.0 / size * 1e-6
+    lat_offset = 180.0 / size * 1e-6
+    for i in range(size):
+        lon = -180.0 + 360.0 * i / size
+        for j in range(size):
+            lat = -90.0 + 180.0 * j / size
+            yield lon, lat
+            yield lon + lon_offset, lat + lat_offset
+            if i and j:
+                yield lon - lon_offset, lat - lat_offset
+    for value in numpy.linspace(-180.0, 180.0, 7):
+        yield value, 90.0
+        yield 180.0, value / 2.0
+
+
+def test_quadkey_matches_tile_bounds():
+    for zoom_level in (0, 1, 3, 5):
+        for lon, lat in corner_points(zoom_level):
+            key = utils.quadkey(lon, lat, zoom_level)
+            if lon == 180.0 or lat == 90.0:
+                # Outside the world bbox, as for vectortile.Bbox.contains()
+                assert key is None
+                continue
+            expected = str(vectortile.TileBounds.from_point(lon, lat, zoom_level))
+            assert utils.quadkey2gridcode(key, zoom_level) == expected, (lon, lat, zoom_level)
+            assert utils.gridcode2quadkey(expected) == key
+
+
+def test_quadkeys_matches_tile_bounds():
+    for zoom_level in (0, 1, 3, 5, vectortile.TileBounds.maxzoom):
+        points = list(corner_points(min(zoom_level, 5)))
+        lons = numpy.array([lon for lon, lat in points])
+        lats = numpy.array([lat for lon, lat in points])
+        keys = utils.quadkeys(lons, lats, zoom_level)
+        for lon, lat, key in zip(lons, lats, keys.tolist()):
+            expected = str(vectortile.TileBounds.from_point(lon, lat, zoom_level))
+            assert utils.quadkey2gridcode(key, zoom_level) == expected, (lon, lat, zoom_level)
+
+
+def test_quadkeys_match_quadkey():
+    numpy.random.seed(0)
+    lons = numpy.random.uniform(-180.0, 180.0, 1000)
+    lats = numpy.random.uniform(-90.0, 90.0, 1000)
+    for zoom_level in (2, 13, 21, 31):
+        keys = utils.quadkeys(lons, lats, zoom_level).tolist()
+        assert keys == [utils.quadkey(lon, lat, zoom_level) for lon, lat in zip(lons, lats)]